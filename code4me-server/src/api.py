@@ -1,19 +1,26 @@
 from __future__ import annotations 
-import os, time, random, json, uuid, glob, torch, traceback
+import os, time, random, json, uuid, torch, traceback
 
 from enum import Enum
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 from model import Model
 from datetime import datetime
-from joblib import Parallel, delayed
+from concurrent.futures import Future, CancelledError, TimeoutError as FutureTimeoutError, as_completed
 from flask import Blueprint, request, Response, redirect, current_app
 from limiter import limiter
+from workers import workers, queue_depths, WorkerBusy
+from typeahead import typeahead_cache
+from completion_cache import completion_cache
+from query_filter import Filter
+from cancellation import CancellationToken, Cancelled, DEADLINES
+from store import LogStore, InvalidToken, AlreadyVerified
 
 from user_study import (
     filter_request, 
+    peek_request_filter,
     store_completion_request,
     should_prompt_survey,
-    USER_STUDY_DIR,
+    study_store,
 )
 
 v1 = Blueprint("v1", __name__)
@@ -21,6 +28,25 @@ v2 = Blueprint("v2", __name__)
 
 os.makedirs("data", exist_ok=True)
 
+# Start generating while the request filter runs, instead of after it. Costs the generation of
+# every request the filter drops, but takes the filter off the critical path.
+SPECULATIVE_GENERATION = os.getenv("SPECULATIVE_GENERATION", "False") == "True"
+# filters that are cheap compared to generating, and so are not worth speculating past
+CHEAP_FILTERS = {Filter.NO_FILTER, Filter.FEATURE}
+
+# completions of the v1 api, which used to be stored as data/user_token-verify_token.json
+v1_store = LogStore(os.path.join('data', 'store'), chunked_fields=('leftContext', 'rightContext'))
+
+def metrics() -> dict:
+    ''' The worker queue depths, the completion cache's hit rate, and the stores' queue depths and flush latencies.
+        app.py logs them periodically. '''
+    return {
+        'queue_depths': queue_depths(),
+        'completion_cache': completion_cache.stats(),
+        'study_store': study_store.stats(),
+        'v1_store': v1_store.stats(),
+    }
+
 def authorise(req) -> str: 
     ''' Authorise the request. Raise ValueError if the request is not authorised. '''
 
@@ -29,24 +55,108 @@ def authorise(req) -> str:
         raise ValueError("Missing bearer token")
     return auth
 
-def get_predictions(completion_request: dict) -> Tuple[float, dict[str, str]]: 
-    ''' Return a list of predictions. '''
+def submit_predictions(completion_request: dict, session: str = None, cancel_token: CancellationToken = None) \
+        -> Tuple[dict[str, str], dict[Model, Future]]:
+    ''' Submit the request to the model workers, except for the models whose prediction can be typed-ahead
+        from the session's previous completion. `session` allows the models to reuse work across a user's requests,
+        and `cancel_token` stops their generation loops once it is cancelled. '''
 
     prefix = completion_request['prefix'].rstrip()
     suffix = completion_request['suffix']
 
-    def predict_model(model: Model) -> str:
-        try:
-            return model.value[1](prefix, suffix)[0]
-        except torch.cuda.OutOfMemoryError:
-            exit(1)
+    typed_ahead = {
+        model.name: typeahead_cache.lookup(session, model.name, completion_request['prefix'], suffix)
+        for model in Model
+    } if session is not None else {}
+    typed_ahead = {name: completion for name, completion in typed_ahead.items() if completion is not None}
+
+    futures = {
+        model: submit_prediction(model, prefix, suffix, session=session, cancel_token=cancel_token)
+        for model in Model if model.name not in typed_ahead
+    }
+    return typed_ahead, futures
+
+def submit_prediction(model: Model, *args, **kwargs) -> Future:
+    ''' Submit a request to the model's worker. If the worker is busy, the future fails with `WorkerBusy`: 
+        the other models can still answer, and this one is left out like a model that timed out. '''
+
+    try:
+        return workers[model].submit(*args, **kwargs)
+    except WorkerBusy as e:
+        current_app.logger.warning(str(e))
+        future = Future()
+        future.set_exception(e)
+        return future
+
+def start_predictions(completion_request: dict, session: str = None) \
+        -> Tuple[datetime, CancellationToken, dict[str, str], dict[Model, Future]]:
+    ''' Submit the request under the trigger's deadline, returning the start time and cancellation token with it. '''
 
     t0 = datetime.now()
-    predictions = Parallel(n_jobs=os.cpu_count(), prefer="threads")(delayed(predict_model)(model) for model in Model)
+    cancel_token = CancellationToken.for_trigger(completion_request.get('trigger'))
+    typed_ahead, futures = submit_predictions(completion_request, session, cancel_token)
+    return t0, cancel_token, typed_ahead, futures
+
+def speculate(user_uuid: str, completion_request: dict):
+    ''' Start predictions before the request is filtered, if speculative generation is enabled and 
+        the user's filter is expensive enough to be worth it. Returns None otherwise. '''
+
+    if not SPECULATIVE_GENERATION or peek_request_filter(user_uuid, datetime.now()) in CHEAP_FILTERS:
+        return None
+    return start_predictions(completion_request, session=user_uuid)
+
+def cancel_predictions(started) -> dict:
+    ''' Cancel the predictions of a request that was filtered after all, returning the compute they used:
+        the time until they were cancelled, and how far each model got. '''
+
+    t0, cancel_token, _, futures = started
+    cancel_token.cancel()
+
+    # a future that is still queued never reaches the model
+    models = {model.name: 'queued' if future.cancel() else 'done' if future.done() else 'running'
+              for model, future in futures.items()}
+    return {
+        'time': (datetime.now() - t0).total_seconds() * 1000,
+        'models': models,
+    }
+
+def get_predictions(completion_request: dict, session: str = None, started=None) \
+        -> Tuple[float, dict[str, str], List[str], List[str]]: 
+    ''' Return a list of predictions, the models whose prediction was typed-ahead, and the models that did not
+        finish before the trigger's deadline or whose worker was busy (their prediction is empty). `started` continues the predictions of 
+        an earlier `start_predictions` call, instead of submitting the request again. '''
+
+    t0, cancel_token, typed_ahead, futures = started or start_predictions(completion_request, session)
+
+    predictions, timed_out = {}, []
+    for model in Model:
+        if model.name in typed_ahead:
+            predictions[model.name] = typed_ahead[model.name]
+            continue
+        prediction = await_prediction(futures[model], timeout=cancel_token.remaining())
+        if prediction is None:
+            timed_out.append(model.name)
+        predictions[model.name] = prediction[0] if prediction else ''
+
+    # stop the late models' generation loops, the editor no longer needs their completion
+    cancel_token.cancel()
     time = (datetime.now() - t0).total_seconds() * 1000
 
-    predictions = {model.name: prediction for model, prediction in zip(Model, predictions)}
-    return time, predictions
+    if session is not None:
+        typeahead_cache.remember(session, completion_request['prefix'], completion_request['suffix'], predictions)
+
+    return time, predictions, list(typed_ahead), timed_out
+
+def await_prediction(future: Future, timeout: float = None) -> Optional[List[str]]:
+    ''' Wait for a model worker to finish, exiting on OOM such that the container is restarted.
+        Return None if the model was cancelled, its worker was busy, or it did not finish within `timeout` seconds. '''
+
+    try:
+        return future.result(timeout=timeout)
+    except (Cancelled, CancelledError, FutureTimeoutError, WorkerBusy):
+        return None
+    except torch.cuda.OutOfMemoryError:
+        exit(1)
 
 @v2.route("/prediction/autocomplete", methods=["POST"])
 @limiter.limit("4000/hour")
@@ -56,13 +166,17 @@ def autocomplete_v2():
         # TODO: As we want every request to be authorised, this can be extracted into a decorator
         user_uuid = authorise(request)
         request_json = request.json
+        queue_depth = queue_depths()
+        speculation = speculate(user_uuid, request_json)
 
         # TODO: add a None filter type for baseline comparison
         filter_time, filter_type, should_filter = filter_request(user_uuid, request_json)
+        should_predict = (not should_filter) or (request_json['trigger'] == 'manual')
 
-        predict_time, predictions = get_predictions(request_json) \
-            if (not should_filter) or (request_json['trigger'] == 'manual') \
-            else (None, {}) 
+        predict_time, predictions, typed_ahead, timed_out = \
+            get_predictions(request_json, session=user_uuid, started=speculation) \
+            if should_predict else (None, {}, [], []) 
+        speculation_cost = cancel_predictions(speculation) if speculation is not None and not should_predict else None
 
         log_filter = f'\033[1m{"filter" if should_filter else "predict"}\033[0m'
         log_context = f'{request_json["prefix"][-10:]}•{request_json["suffix"][:5]}'
@@ -79,6 +193,12 @@ def autocomplete_v2():
             'should_filter': should_filter,
             'predict_time': predict_time,
             'predictions': predictions,
+            'typed_ahead': typed_ahead,
+            'timed_out': timed_out,
+            'deadline_ms': DEADLINES.get(request_json.get('trigger'), 0),
+            'queue_depth': queue_depth,
+            'speculative': speculation is not None,
+            'speculation_cost': speculation_cost,
             'survey': prompt_survey,
             'study_version': '0.0.1'
         })
@@ -100,6 +220,99 @@ def autocomplete_v2():
 
         return response({ "error": error_uuid }, status=400)
 
+@v2.route("/prediction/autocomplete/stream", methods=["POST"])
+@limiter.limit("4000/hour")
+def autocomplete_stream_v2():
+    ''' Same as `autocomplete_v2`, but sends each model's prediction as a Server-Sent Event as soon as
+        it is ready. The first event carries the verify token, and the request is stored when the stream closes. '''
+
+    try:
+        user_uuid = authorise(request)
+        request_json = request.json
+        queue_depth = queue_depths()
+        speculation = speculate(user_uuid, request_json)
+
+        filter_time, filter_type, should_filter = filter_request(user_uuid, request_json)
+        should_predict = (not should_filter) or (request_json['trigger'] == 'manual')
+
+        verify_token = uuid.uuid4().hex if not should_filter else ''
+        prompt_survey = should_prompt_survey(user_uuid) if not should_filter else False
+
+        speculation_cost = cancel_predictions(speculation) if speculation is not None and not should_predict else None
+        t0, cancel_token, typed_ahead, futures = (speculation or start_predictions(request_json, session=user_uuid)) \
+            if should_predict else (datetime.now(), CancellationToken(), {}, {})
+
+    except Exception as e:
+
+        error_uuid = uuid.uuid4().hex 
+        current_app.logger.warning(f'''
+        Error {error_uuid} for {user_uuid if user_uuid is not None else "unauthenticated user"}
+        {request.json if request.is_json else "no request json found"}
+        ''')
+        traceback.print_exc()
+
+        return response({ "error": error_uuid }, status=400)
+
+    logger = current_app.logger
+
+    def stream():
+        predictions, timed_out = {}, []
+        try:
+            yield server_sent_event('start', {'verifyToken': verify_token, 'survey': prompt_survey})
+
+            for model_name, prediction in typed_ahead.items():
+                predictions[model_name] = prediction
+                yield server_sent_event('prediction', {'model': model_name, 'prediction': prediction})
+
+            model_names = {future: model.name for model, future in futures.items()}
+            try:
+                for future in as_completed(model_names, timeout=cancel_token.remaining()):
+                    prediction = await_prediction(future)
+                    if prediction is None:
+                        timed_out.append(model_names[future])
+                        continue
+                    predictions[model_names[future]] = prediction[0]
+                    yield server_sent_event('prediction', {'model': model_names[future], 'prediction': prediction[0]})
+            except FutureTimeoutError:
+                timed_out += [name for name in model_names.values() if name not in predictions and name not in timed_out]
+
+            yield server_sent_event('end', {'timedOut': timed_out})
+
+        finally:
+            cancel_token.cancel()
+            # runs once the stream is closed, including when the client disconnects early
+            predict_time = (datetime.now() - t0).total_seconds() * 1000 if should_predict else None
+            if should_predict and len(predictions) == len(Model):
+                typeahead_cache.remember(user_uuid, request_json['prefix'], request_json['suffix'], predictions)
+
+            log_filter = f'\033[1m{"filter" if should_filter else "predict"}\033[0m'
+            log_context = f'{request_json["prefix"][-10:]}•{request_json["suffix"][:5]}'
+            logger.warning(f'{log_filter} {log_context} \t{filter_type} {[v[:10] for v in predictions.values()]} (stream)')
+
+            store_completion_request(user_uuid, verify_token, {
+                **request_json,
+                'timestamp': datetime.now().isoformat(),
+                'filter_type': filter_type,  
+                'filter_time': filter_time,
+                'should_filter': should_filter,
+                'predict_time': predict_time,
+                'predictions': predictions,
+                'typed_ahead': list(typed_ahead),
+                'timed_out': timed_out,
+                'deadline_ms': DEADLINES.get(request_json.get('trigger'), 0),
+                'queue_depth': queue_depth,
+                'speculative': speculation is not None,
+                'speculation_cost': speculation_cost,
+                'survey': prompt_survey,
+                'streamed': True,
+                'study_version': '0.0.1'
+            })
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # otherwise nginx buffers the events
+    })
+
 @v2.route("/prediction/verify", methods=["POST"])
 @limiter.limit("4000/hour")
 def verify_v2():
@@ -110,21 +323,16 @@ def verify_v2():
     # current_app.logger.info(verify_json)
 
     verify_token = verify_json['verifyToken']
-    file_path = os.path.join(USER_STUDY_DIR, user_uuid, f'{verify_token}.json')
-
-    with open(file_path, 'r+') as completion_file:
-        completion_json = json.load(completion_file)
-
-        if 'ground_truth' in completion_json:
-            return response({
-                "error": "Already used verify token"
-            }, status=400)
-
-        completion_json.update(verify_json)
-
-        completion_file.seek(0)
-        completion_file.write(json.dumps(completion_json))
-        completion_file.truncate()
+    try:
+        study_store.verify(user_uuid, verify_token, verify_json)
+    except InvalidToken:
+        return response({
+            "error": "Invalid verify token"
+        }, status=400)
+    except AlreadyVerified:
+        return response({
+            "error": "Already used verify token"
+        }, status=400)
 
     return response({'success': True})
 
@@ -164,15 +372,15 @@ def autocomplete():
     t_before = datetime.now()
     predictions = {}
     unique_predictions_set = set()
-
-    def predict_model(model: Model) -> List[str]:
-        try:
-            return model.value[1](stripped_left_context, right_context)
-        except torch.cuda.OutOfMemoryError:
-            exit(1)
-
-    results = Parallel(n_jobs=os.cpu_count(), prefer="threads")(delayed(predict_model)(model) for model in Model)
-    for model, model_predictions in zip(Model, results):
+    timed_out = []
+
+    futures = {model: submit_prediction(model, stripped_left_context, right_context, session=user_token) 
+               for model in Model}
+    for model, future in futures.items():
+        model_predictions = await_prediction(future)
+        if model_predictions is None:  # busy or cancelled, the other models still answer
+            timed_out.append(model.name)
+            continue
         predictions[model.name] = model_predictions
         unique_predictions_set.update(model_predictions)
 
@@ -182,27 +390,24 @@ def autocomplete():
 
     verify_token = uuid.uuid4().hex
 
-    with open(f"data/{user_token}-{verify_token}.json", "w+") as f:
-        f.write(json.dumps({
-            "completionTimestamp": datetime.now().isoformat(),
-            "triggerPoint": values["triggerPoint"],
-            "language": values["language"].lower(),
-            "ide": values["ide"].lower(),
-            "modelPredictions": predictions,
-            "predictions": unique_predictions,
-            "inferenceTime": (t_after - t_before).total_seconds() * 1000,
-            "leftContextLength": len(left_context),
-            "rightContextLength": len(right_context),
-            "keybind": values["keybind"],
-            "pluginVersion": values["pluginVersion"],
-            "leftContext": left_context if store_context else None,
-            "rightContext": right_context if store_context else None
-        }))
-
-    # # # TODO: disabled surveys temporarily, as we are currently looking through >1M files on every request. 
-    # n_suggestions = len(glob.glob(f"data/{user_token}*.json"))
-    # survey = n_suggestions >= 100 and n_suggestions % 50 == 0
-    survey = False
+    v1_store.append(user_token, verify_token, {
+        "completionTimestamp": datetime.now().isoformat(),
+        "triggerPoint": values["triggerPoint"],
+        "language": values["language"].lower(),
+        "ide": values["ide"].lower(),
+        "modelPredictions": predictions,
+        "predictions": unique_predictions,
+        "timedOut": timed_out,
+        "inferenceTime": (t_after - t_before).total_seconds() * 1000,
+        "leftContextLength": len(left_context),
+        "rightContextLength": len(right_context),
+        "keybind": values["keybind"],
+        "pluginVersion": values["pluginVersion"],
+        "leftContext": left_context if store_context else None,
+        "rightContext": right_context if store_context else None
+    })
+
+    survey = should_prompt_survey(user_token, v1_store)
 
     return response({
         "predictions": unique_predictions,
@@ -230,25 +435,19 @@ def verify():
         return res
 
     verify_token = values["verifyToken"]
-    file_path = f"data/{user_token}-{verify_token}.json"
-    if not os.path.exists(file_path):
+    try:
+        v1_store.verify(user_token, verify_token, {
+            "chosenPrediction": values["chosenPrediction"],
+            "groundTruth": values["groundTruth"],
+        })
+    except InvalidToken:
         return response({
             "error": "Invalid verify token"
         }, status=400)
-
-    with open(file_path, "r+") as completion_file:
-        prediction_data = json.load(completion_file)
-        if "groundTruth" in prediction_data:
-            return response({
-                "error": "Already used verify token"
-            }, status=400)
-
-        prediction_data["chosenPrediction"] = values["chosenPrediction"]
-        prediction_data["groundTruth"] = values["groundTruth"]
-
-        completion_file.seek(0)
-        completion_file.write(json.dumps(prediction_data))
-        completion_file.truncate()
+    except AlreadyVerified:
+        return response({
+            "error": "Already used verify token"
+        }, status=400)
 
     return response({
         "success": True
@@ -295,5 +494,9 @@ def get_body_value(body, key, obj, optional=False):
     return value, None
 
 
+def server_sent_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 def response(body, status=200):
     return Response(json.dumps(body, indent=2), mimetype="application/json", status=status)
@@ -1,8 +1,8 @@
-import markdown, os
+import markdown, os, sys, json, time, signal, threading
 
 from pathlib import Path
 from flask import Flask, jsonify, render_template
-from api import v1, v2
+from api import v1, v2, metrics
 from limiter import limiter
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
@@ -10,6 +10,9 @@ limiter.init_app(app)
 app.register_blueprint(v1, url_prefix='/api/v1')
 app.register_blueprint(v2, url_prefix='/api/v2')
 
+# seconds between logging the api's metrics, 0 disables it
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', 300))
+
 markdown_path = 'markdowns/index.md' 
 index_md = markdown.markdown(Path(markdown_path).read_text())
 
@@ -25,5 +28,15 @@ def home():
     return render_template("index.html", md=index_md)
 
 
+def log_metrics():
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        app.logger.warning(f'metrics {json.dumps(metrics())}')
+
+
 if __name__ == "__main__":
+    if METRICS_INTERVAL > 0:
+        threading.Thread(target=log_metrics, name='metrics', daemon=True).start()
+    # exit normally on `docker stop`, so the stores write their queued records at exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     app.run(host='0.0.0.0', port=3000)
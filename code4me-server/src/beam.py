@@ -0,0 +1,148 @@
+import torch
+
+from typing import List, Tuple, Union
+
+''' Beam search shared by CodeGPT and UniXcoder. Based on the `Beam` classes that came with both
+    models, but keeps its state in (batch, beam) tensors so EOS masking and finished-hypothesis
+    tracking do not sync with the device on every element. Only `done()` syncs, once per step. '''
+
+
+class Beam(object):
+
+    def __init__(self, size: int, sos: Union[int, torch.Tensor], eos: Union[int, List[int]], device,
+                 batch_size: int = 1, include_eos: bool = False):
+        '''
+        Parameters:
+
+        * `size`- beam size
+        * `sos`- token the beams start from
+        * `eos`- end of sequence token(s)
+        * `batch_size`- number of independent searches that are advanced together
+        * `include_eos`- whether `buildTargetTokens` keeps the eos token at the end of a hypothesis
+        '''
+        self.size = size
+        self.batch_size = batch_size
+        self.device = device
+        self.include_eos = include_eos
+        self._eos = torch.tensor(eos if isinstance(eos, list) else [eos], device=device)
+
+        # The score for each translation on the beam.
+        self.scores = torch.zeros(batch_size, size, device=device)
+        # The backpointers at each time-step.
+        self.prevKs = []
+        # The outputs at each time-step.
+        self.nextYs = [torch.zeros(batch_size, size, dtype=torch.long, device=device).fill_(sos)]
+        # The scores, and whether the output was EOS, at each time-step (used to collect finished hypotheses)
+        self.stepScores = []
+        self.stepEos = []
+        # Has EOS topped the beam yet, and how many hypotheses have finished.
+        self.eosTop = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        self.nFinished = torch.zeros(batch_size, dtype=torch.long, device=device)
+
+    def isEos(self, tokens: torch.Tensor) -> torch.Tensor:
+        return (tokens.unsqueeze(-1) == self._eos).any(-1)
+
+    def getCurrentState(self):
+        "Get the outputs for the current timestep, as a (batch * beam, 1) tensor."
+        return self.nextYs[-1].view(-1, 1)
+
+    def getCurrentOrigin(self):
+        "Get the backpointers for the current timestep, as indices into the (batch * beam) rows."
+        offsets = torch.arange(self.batch_size, device=self.device).unsqueeze(1) * self.size
+        return (self.prevKs[-1] + offsets).view(-1)
+
+    def advance(self, wordLk):
+        """
+        Given prob over words for every last beam `wordLk`: Compute and update the beam search.
+
+        Parameters:
+
+        * `wordLk`- probs of advancing from the last step ((batch * beam) x words)
+        """
+        numWords = wordLk.size(-1)
+        wordLk = wordLk.view(self.batch_size, self.size, numWords)
+
+        # Sum the previous scores.
+        if len(self.prevKs) > 0:
+            beamLk = wordLk + self.scores.unsqueeze(-1)
+
+            # Don't let EOS have children.
+            beamLk = beamLk.masked_fill(self.isEos(self.nextYs[-1]).unsqueeze(-1), -1e20)
+        else:
+            beamLk = wordLk[:, :1]
+        flatBeamLk = beamLk.reshape(self.batch_size, -1)
+        bestScores, bestScoresId = flatBeamLk.topk(self.size, -1, True, True)
+
+        self.scores = bestScores
+
+        # bestScoresId is flattened beam x word array, so calculate which
+        # word and beam each score came from
+        prevK = torch.div(bestScoresId, numWords, rounding_mode='floor')
+        self.prevKs.append(prevK)
+        self.nextYs.append(bestScoresId - prevK * numWords)
+
+        eos = self.isEos(self.nextYs[-1])
+        self.stepScores.append(bestScores)
+        self.stepEos.append(eos)
+        self.nFinished += eos.sum(-1)
+
+        # End condition is when top-of-beam is EOS and no global score.
+        self.eosTop |= eos[:, 0]
+
+    def done(self):
+        return bool((self.eosTop & (self.nFinished >= self.size)).all())
+
+    def getFinal(self, batch_idx: int = 0) -> List[Tuple[float, int, int]]:
+        ''' The best `size` (score, timestep, beam) triples: finished hypotheses first,
+            topped up with the best unfinished ones of the last timestep. '''
+
+        timestep = len(self.nextYs) - 1
+        if timestep == 0:
+            return [(0.0, 0, 0)]
+
+        scores = torch.stack([s[batch_idx] for s in self.stepScores]).tolist()
+        eos = torch.stack([e[batch_idx] for e in self.stepEos]).tolist()
+
+        finished = [(scores[t][k], t + 1, k) for t in range(timestep) for k in range(self.size) if eos[t][k]]
+        if len(finished) == 0:
+            finished.append((scores[-1][0], timestep, 0))
+        finished.sort(key=lambda a: -a[0])
+        if len(finished) < self.size:
+            unfinished = [(scores[-1][k], timestep, k) for k in range(self.size) if not eos[-1][k]]
+            unfinished.sort(key=lambda a: -a[0])
+            finished += unfinished[:self.size - len(finished)]
+        return finished[:self.size]
+
+    def getHyp(self, beam_res, batch_idx: int = 0) -> List[List[int]]:
+        """
+        Walk back to construct the full hypotheses, for all of them at once.
+        """
+        if len(beam_res) == 0 or len(self.prevKs) == 0:
+            return [[] for _ in beam_res]
+
+        timesteps = torch.tensor([timestep for _, timestep, _ in beam_res], device=self.device)
+        ks = torch.tensor([k for _, _, k in beam_res], device=self.device)
+        nextYs = torch.stack([y[batch_idx] for y in self.nextYs])
+        prevKs = torch.stack([p[batch_idx] for p in self.prevKs])
+
+        hyps = torch.zeros(len(beam_res), len(self.prevKs), dtype=torch.long, device=self.device)
+        for j in range(len(self.prevKs) - 1, -1, -1):
+            active = j < timesteps
+            hyps[:, j] = nextYs[j + 1][ks]
+            ks = torch.where(active, prevKs[j][ks], ks)
+
+        return [hyp[:timestep] for hyp, timestep in zip(hyps.tolist(), timesteps.tolist())]
+
+    def buildTargetTokens(self, preds):
+        eos = set(self._eos.tolist())
+        sentence = []
+        for pred in preds:
+            tokens = []
+            for tok in pred:
+                if tok in eos:
+                    if self.include_eos:
+                        tokens.append(tok)
+                    break
+                tokens.append(tok)
+            sentence.append(tokens)
+        return sentence
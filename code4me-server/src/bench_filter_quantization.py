@@ -0,0 +1,62 @@
+import time, argparse, torch, numpy as np
+
+from query_filter import FILTER_MODELS, MyPipeline, get_model, set_all_seeds
+from import_study_data import load_requests
+
+''' Replays the completion requests logged in --data-dir (its store, and the files that were not imported into
+    it) through every transformer filter, once with the fp32 model and once with its int8 dynamically quantized
+    version (`get_model(..., quantize=True)`), on CPU. Reports latency percentiles of both, and how often the
+    quantized filter makes the same decision as the fp32 one.
+
+    python bench_filter_quantization.py --data-dir data_aral --limit 500 '''
+
+FEATURE_KEYS = ('prefix', 'suffix', 'ide', 'language', 'time_since_last_completion')
+
+
+def replay(pipeline: MyPipeline, requests):
+    ''' The decision and latency (in ms) of every request, classified one at a time like the server does '''
+
+    decisions, latencies = [], []
+    with torch.no_grad():
+        for request_json in requests:
+            t0 = time.perf_counter()
+            inputs = pipeline.preprocess(request_json)
+            decisions.append(pipeline.postprocess(pipeline.model(**inputs)))
+            latencies.append((time.perf_counter() - t0) * 1000)
+    return decisions, latencies
+
+
+def percentiles(latencies) -> str:
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return f'p50 {p50:.1f}ms  p90 {p90:.1f}ms  p99 {p99:.1f}ms'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare int8 quantized filters to fp32 on logged requests')
+    parser.add_argument('--data-dir', default='data_aral')
+    parser.add_argument('--limit', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=None, help='torch intra-op threads')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    requests = load_requests(args.data_dir, args.limit, FEATURE_KEYS)
+    if len(requests) == 0:
+        raise SystemExit(f'No logged requests with the filter features in {args.data_dir}')
+    print(f'replaying {len(requests)} requests')
+
+    for filter_type, model_name in FILTER_MODELS.items():
+        results = {}
+        for quantize in (False, True):
+            set_all_seeds()
+            model = get_model(model_name, quantize=quantize)
+            pipeline = MyPipeline(device=-1, task='text-classification', model=model, incl_features=True)
+            results[quantize] = replay(pipeline, requests)
+
+        (fp32_decisions, fp32_latencies), (int8_decisions, int8_latencies) = results[False], results[True]
+        agreement = np.mean([a == b for a, b in zip(fp32_decisions, int8_decisions)])
+        print(f'\033[1m{filter_type.value}\033[0m')
+        print(f'\tfp32  {percentiles(fp32_latencies)}')
+        print(f'\tint8  {percentiles(int8_latencies)}')
+        print(f'\tdecision agreement {agreement:.2%}')
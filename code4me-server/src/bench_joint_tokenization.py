@@ -0,0 +1,67 @@
+import time, argparse
+
+from transformers import AutoTokenizer
+from tokenization import joint_token_ids
+from import_study_data import load_requests
+
+''' Compares `joint_token_ids` to the previous `tokenize_joint_sample`, which tokenised the suffix twice and
+    switched the shared tokenizer's truncation side, on the completion requests logged in --data-dir (its
+    store, and the files that were not imported into it). Reports whether the input ids and attention masks
+    are identical, and how long each implementation takes.
+
+    python bench_joint_tokenization.py --data-dir data_aral --limit 1000 '''
+
+
+def reference_token_ids(tokenizer, prefix: str, suffix: str, max_length: int = 512, max_suffix_tokens: int = 128):
+    ''' The previous implementation in `query_filter.tokenize_joint_sample` '''
+
+    tokenizer.truncation_side = 'right'
+    suffix_tokens = tokenizer(suffix, padding='do_not_pad', truncation=True, max_length=max_suffix_tokens + 1)
+    n_suffix_tokens = len(suffix_tokens['input_ids']) - 1
+
+    tokenizer.truncation_side = 'left'
+    prefix_tokens = tokenizer(prefix, padding='do_not_pad', truncation=True, max_length=max_length - n_suffix_tokens)
+
+    n_prefix_tokens = len(prefix_tokens['input_ids'])
+    tokenizer.truncation_side = 'right'
+    suffix_tokens = tokenizer(suffix, padding='max_length', truncation=True, max_length=max_length - n_prefix_tokens + 1)
+
+    return (prefix_tokens['input_ids'] + suffix_tokens['input_ids'][1:],
+            prefix_tokens['attention_mask'] + suffix_tokens['attention_mask'][1:])
+
+
+def timed(fn, tokenizer, requests, repeat: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        for prefix, suffix in requests:
+            fn(tokenizer, prefix, suffix)
+    return (time.perf_counter() - t0) * 1000 / (repeat * len(requests))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare joint_token_ids to the previous joint tokenisation')
+    parser.add_argument('--data-dir', default='data_aral')
+    parser.add_argument('--tokenizer', default='huggingface/CodeBERTa-small-v1')
+    parser.add_argument('--limit', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    requests = [(request_json['prefix'], request_json['suffix'])
+                for request_json in load_requests(args.data_dir, args.limit, ('prefix', 'suffix'))]
+    if len(requests) == 0:
+        raise SystemExit(f'No logged requests with a prefix and suffix in {args.data_dir}')
+
+    mismatches = 0
+    for prefix, suffix in requests:
+        if joint_token_ids(tokenizer, prefix, suffix) != reference_token_ids(tokenizer, prefix, suffix):
+            mismatches += 1
+    print(f'{len(requests) - mismatches}/{len(requests)} requests tokenised identically')
+
+    reference_ms = timed(reference_token_ids, tokenizer, requests, args.repeat)
+    joint_ms = timed(joint_token_ids, tokenizer, requests, args.repeat)
+    print(f'reference: {reference_ms:.3f} ms/request, joint: {joint_ms:.3f} ms/request '
+          f'({reference_ms / joint_ms:.1f}x)')
+
+    if mismatches > 0:
+        raise SystemExit(1)
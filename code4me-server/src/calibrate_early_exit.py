@@ -0,0 +1,95 @@
+import os, json, argparse, torch
+
+from query_filter import FILTER_MODELS, MODELS_DIR, EARLY_EXIT_FILE, MyPipeline, Filter, get_model, set_all_seeds
+from bench_filter_quantization import FEATURE_KEYS
+from import_study_data import load_requests
+
+''' Picks the early-exit thresholds of the transformer filters from the requests logged in --data-dir (its store,
+    and the files that were not imported into it). For every request, the classification head is applied after
+    each layer. Going from the first layer up, a layer's threshold is the smallest logit margin such that the
+    requests that would exit there agree with the full-depth decision at least `--target` of the time. Exits at
+    every layer meet the target, so overall agreement does too.
+    Thresholds are written to models/<model>/early_exit.json, and used with FILTER_EARLY_EXIT=True.
+
+    python calibrate_early_exit.py --data-dir data_aral --target 0.99 '''
+
+
+def layer_margins(pipeline: MyPipeline, requests):
+    ''' Per request, the (margin, decision) of the classification head after every layer '''
+
+    results = []
+    with torch.no_grad():
+        for request_json in requests:
+            inputs = pipeline._ensure_tensor_on_device(pipeline.preprocess(request_json), pipeline.device)
+            layers = []
+            for _, logits in pipeline.model.layer_logits(**inputs):
+                top2 = logits[0].topk(2)
+                layers.append(((top2.values[0] - top2.values[1]).item(), top2.indices[0].item()))
+            results.append(layers)
+    return results
+
+
+def calibrate(results, target: float, min_exits: int):
+    ''' Returns the thresholds {layer_idx: margin}, the agreement with full depth, and the mean number of layers '''
+
+    n_layers = len(results[0])
+    remaining = list(range(len(results)))
+    thresholds, agree, layers_run = {}, 0, 0
+
+    for layer_idx in range(n_layers - 1):
+        # most confident first, so every prefix of this list is the set that exits at some threshold
+        candidates = sorted(remaining, key=lambda i: -results[i][layer_idx][0])
+        best, n_agree = None, 0
+        for n, i in enumerate(candidates, start=1):
+            n_agree += results[i][layer_idx][1] == results[i][-1][1]
+            if n >= min_exits and n_agree / n >= target:
+                best = (n, n_agree)
+
+        if best is None:
+            continue
+        n, n_agree = best
+        thresholds[layer_idx] = results[candidates[n - 1]][layer_idx][0]
+        exited = {i for i in remaining if results[i][layer_idx][0] >= thresholds[layer_idx]}
+        agree += sum(results[i][layer_idx][1] == results[i][-1][1] for i in exited)
+        layers_run += len(exited) * (layer_idx + 1)
+        remaining = [i for i in remaining if i not in exited]
+
+    agree += len(remaining)
+    layers_run += len(remaining) * n_layers
+    return thresholds, agree / len(results), layers_run / len(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calibrate early-exit thresholds of the transformer filters')
+    parser.add_argument('--data-dir', default='data_aral')
+    parser.add_argument('--limit', type=int, default=2000)
+    parser.add_argument('--target', type=float, default=0.99, help='minimum agreement with full-depth decisions')
+    parser.add_argument('--min-exits', type=int, default=20, help='minimum number of requests to set a threshold on')
+    parser.add_argument('--filters', default=','.join(f.value for f in FILTER_MODELS))
+    parser.add_argument('--dry-run', action='store_true', help='only print the thresholds')
+    args = parser.parse_args()
+
+    requests = load_requests(args.data_dir, args.limit, FEATURE_KEYS)
+    if len(requests) == 0:
+        raise SystemExit(f'No logged requests with the filter features in {args.data_dir}')
+
+    for value in args.filters.split(','):
+        model_name = FILTER_MODELS[Filter(value)]
+        set_all_seeds()
+        model = get_model(model_name)
+        pipeline = MyPipeline(device=-1, task='text-classification', model=model, incl_features=True)
+
+        thresholds, agreement, mean_layers = calibrate(layer_margins(pipeline, requests), args.target, args.min_exits)
+        calibration = {
+            'thresholds': thresholds,
+            'target': args.target,
+            'agreement': agreement,
+            'mean_layers': mean_layers,
+            'n_layers': model.config.num_hidden_layers,
+            'n_requests': len(requests),
+        }
+        print(f'\033[1m{value}\033[0m {json.dumps(calibration)}')
+
+        if not args.dry_run:
+            with open(os.path.join(MODELS_DIR, model_name, EARLY_EXIT_FILE), 'w') as f:
+                json.dump(calibration, f, indent=2)
@@ -0,0 +1,52 @@
+import os, time, threading
+
+from typing import Optional
+
+''' Latency deadlines for model fan-out. Every generation loop checks a `CancellationToken`
+    between decode steps, so a model that misses the deadline stops instead of holding on to
+    the device for a completion the editor no longer needs. '''
+
+# per trigger type, in ms. 0 means no deadline, which is the default: a deadline drops the completions of
+# slower models (e.g. InCoder on CPU) from the study data, so it is only applied when configured
+DEADLINES = {
+    'auto': int(os.getenv('DEADLINE_AUTO_MS', 0)),
+    'idle': int(os.getenv('DEADLINE_IDLE_MS', 0)),
+    'manual': int(os.getenv('DEADLINE_MANUAL_MS', 0)),
+}
+
+
+class Cancelled(Exception):
+    ''' Raised by a generation loop that was cancelled, or ran past its deadline '''
+
+
+class CancellationToken:
+
+    def __init__(self, deadline: Optional[float] = None):
+        self.deadline = deadline  # in time.monotonic() seconds
+        self.event = threading.Event()
+
+    @classmethod
+    def for_trigger(cls, trigger: str) -> 'CancellationToken':
+        deadline_ms = DEADLINES.get(trigger, 0)
+        return cls(time.monotonic() + deadline_ms / 1000 if deadline_ms > 0 else None)
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.event.is_set() or (self.deadline is not None and time.monotonic() > self.deadline)
+
+    def remaining(self) -> Optional[float]:
+        ''' Seconds left until the deadline, or None if there is none '''
+        return max(0.0, self.deadline - time.monotonic()) if self.deadline is not None else None
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+
+def check(cancel_token: Optional[CancellationToken]):
+    ''' Raise `Cancelled` if the (optional) token is cancelled '''
+    if cancel_token is not None:
+        cancel_token.check()
@@ -1,5 +1,10 @@
 from typing import List
-from transformers import GPT2LMHeadModel, GPT2Config, GPT2Tokenizer
+from transformers import GPT2LMHeadModel, GPT2Config
+from decode_engine import DecodeAdapter, DecodeEngine, to_past
+from beam import Beam
+from completion_cache import completion_cache, cache_key
+from tokenization import tail_token_ids, codegpt_tokenizer
+from cancellation import CancellationToken, check
 import os
 import torch
 
@@ -16,126 +21,11 @@ if not os.path.exists(checkpoint_path) and not CODE4ME_TEST:
     raise ValueError(f"Invalid checkpoint path: '{checkpoint_path}'")
 
 config = GPT2Config
-tokenizer = GPT2Tokenizer.from_pretrained(checkpoint_path, do_lower_case=False, sep_token='<EOL>',
-                                          bos_token='<s>', eos_token='</s>', pad_token='<pad>',
-                                          unk_token='<|UNKNOWN|>')
+tokenizer = codegpt_tokenizer(checkpoint_path)
 model = GPT2LMHeadModel.from_pretrained(checkpoint_path)
 model.resize_token_embeddings(len(tokenizer))
 
 
-class Beam(object):
-    def __init__(self, size, sos, eos):
-        self.size = size
-        self.tt = torch.cuda if torch.cuda.is_available() else torch
-        # The score for each translation on the beam.
-        self.scores = self.tt.FloatTensor(size).zero_().to(device)
-        # The backpointers at each time-step.
-        self.prevKs = []
-        # The outputs at each time-step.
-        self.nextYs = [self.tt.LongTensor(size)
-                       .fill_(0).to(device)]
-        self.nextYs[0][:] = sos
-        # Has EOS topped the beam yet.
-        self._eos = eos
-        self.eosTop = False
-        # Time and k pair for finished.
-        self.finished = []
-
-    def getCurrentState(self):
-        "Get the outputs for the current timestep."
-        batch = self.tt.LongTensor(self.nextYs[-1]).view(-1, 1)
-        return batch
-
-    def getCurrentOrigin(self):
-        "Get the backpointers for the current timestep."
-        return self.prevKs[-1]
-
-    def advance(self, wordLk):
-        """
-        Given prob over words for every last beam `wordLk` and attention
-        `attnOut`: Compute and update the beam search.
-
-        Parameters:
-
-        * `wordLk`- probs of advancing from the last step (K x words)
-        * `attnOut`- attention at the last step
-
-        Returns: True if beam search is complete.
-        """
-        numWords = wordLk.size(1)
-
-        # Sum the previous scores.
-        if len(self.prevKs) > 0:
-            beamLk = wordLk + self.scores.unsqueeze(1).expand_as(wordLk)
-
-            # Don't let EOS have children.
-            for i in range(self.nextYs[-1].size(0)):
-                if self.nextYs[-1][i] in self._eos:
-                    beamLk[i] = -1e20
-        else:
-            beamLk = wordLk[0]
-        flatBeamLk = beamLk.view(-1)
-        bestScores, bestScoresId = flatBeamLk.topk(self.size, 0, True, True)
-
-        self.scores = bestScores
-
-        # bestScoresId is flattened beam x word array, so calculate which
-        # word and beam each score came from
-        prevK = torch.div(bestScoresId, numWords, rounding_mode='trunc')
-        self.prevKs.append(prevK)
-        self.nextYs.append((bestScoresId - prevK * numWords))
-
-        for i in range(self.nextYs[-1].size(0)):
-            if self.nextYs[-1][i] in self._eos:
-                s = self.scores[i]
-                self.finished.append((s, len(self.nextYs) - 1, i))
-
-        # End condition is when top-of-beam is EOS and no global score.
-        if self.nextYs[-1][0] in self._eos:
-            self.eosTop = True
-
-    def done(self):
-        return self.eosTop and len(self.finished) >= self.size
-
-    def getFinal(self):
-        if len(self.finished) == 0:
-            self.finished.append((self.scores[0], len(self.nextYs) - 1, 0))
-        self.finished.sort(key=lambda a: -a[0])
-        if len(self.finished) != self.size:
-            unfinished = []
-            for i in range(self.nextYs[-1].size(0)):
-                if self.nextYs[-1][i] not in self._eos:
-                    s = self.scores[i]
-                    unfinished.append((s, len(self.nextYs) - 1, i))
-            unfinished.sort(key=lambda a: -a[0])
-            self.finished += unfinished[:self.size - len(self.finished)]
-        return self.finished[:self.size]
-
-    def getHyp(self, beam_res):
-        """
-        Walk back to construct the full hypothesis.
-        """
-        hyps = []
-        for _, timestep, k in beam_res:
-            hyp = []
-            for j in range(len(self.prevKs[:timestep]) - 1, -1, -1):
-                hyp.append(self.nextYs[j + 1][k])
-                k = self.prevKs[j][k]
-            hyps.append(hyp[::-1])
-        return hyps
-
-    def buildTargetTokens(self, preds):
-        sentence = []
-        for pred in preds:
-            tokens = []
-            for tok in pred:
-                tokens.append(tok)
-                if tok in self._eos:
-                    break
-            sentence.append(tokens)
-        return sentence
-
-
 def DecodeIds(idxs):
     codes = ""
     for idx in idxs:
@@ -162,24 +52,45 @@ model.eval()
 break_ids = [tokenizer.sep_token_id]
 
 m = torch.nn.LogSoftmax(dim=-1).to(device)
-# I presume the .cuda. is not necessary here if it is moved to the CUDA device immediately, but not risking it. 
-zero = torch.cuda.LongTensor(1).fill_(0).to(device) if not CODE4ME_TEST else torch.LongTensor(1).fill_(0).to(device)
 
-def codegpt_predict(left_context: str, right_context: str) -> List[str]:
+
+class CodeGPTAdapter(DecodeAdapter):
+
+    def prefill(self, input_ids, past=None):
+        # the last prompt token is fed again as the first decode input, as the beam search did
+        return to_past(model(input_ids, past_key_values=past).past_key_values), None
+
+    def step(self, input_ids, past, attention_mask, position_ids):
+        outputs = model(input_ids, past_key_values=past, attention_mask=attention_mask, position_ids=position_ids)
+        return outputs.logits[:, -1, :], to_past(outputs.past_key_values)
+
+
+# set CODEGPT_MAX_BATCH_SIZE=0 to fall back to decoding each request on its own
+max_batch_size = int(os.environ.get("CODEGPT_MAX_BATCH_SIZE", 8))
+engine = DecodeEngine("codegpt", CodeGPTAdapter(), device, max_batch_size) if max_batch_size > 0 else None
+
+
+def codegpt_predict(left_context: str, right_context: str, session: str = None,
+                    cancel_token: CancellationToken = None) -> List[str]:
     left_context = left_context.replace("\n", "<EOL>")
     input_size = 960
-    predict_size = 64
-    block_size = input_size + predict_size
-
-    # pre-truncate to ensure we do not tokenize too much (takes too long)
-    avg_chars_per_token = 4.26
-    avg_chars_per_token += 1  # add some margin to be safe
-    input = left_context[-int(input_size * avg_chars_per_token):]
 
-    tokens = tokenizer.encode(input)[-(input_size - 1):]
-    # print tokens as strings
+    # only tokenize as far back from the cursor as needed to fill the window
+    tokens = tail_token_ids(tokenizer, left_context, input_size - 1, boundary="<EOL>")
     # prepend with <s>
     tokens = [tokenizer.bos_token_id] + tokens
+
+    return completion_cache.get_or_compute(cache_key("CodeGPT", tokens), lambda: predict_tokens(tokens, session, cancel_token))
+
+
+def predict_tokens(tokens: List[int], session: str = None, cancel_token: CancellationToken = None) -> List[str]:
+    predict_size = 64
+
+    if engine is not None:
+        # greedy decoding, which is what the beam search below does with beam_size = 1
+        return [postprocess(engine.generate(tokens, predict_size, stop_ids=break_ids, session=session,
+                                               cancel_token=cancel_token))]
+
     inputs = torch.tensor(tokens, device=device).unsqueeze(0)
     with torch.no_grad():
         beam_size = 1
@@ -189,11 +100,12 @@ def codegpt_predict(left_context: str, right_context: str) -> List[str]:
             past = [torch.cat([x[0].unsqueeze(0), x[1].unsqueeze(0)], dim=0) if type(x) == tuple else x for x in
                     outputs]
             past_hidden = [x[:, i:i + 1].expand(-1, beam_size, -1, -1, -1) for x in past]
-            beam = Beam(beam_size, inputs[i][-1].data, break_ids)
+            beam = Beam(beam_size, inputs[i][-1].data, break_ids, device, include_eos=True)
             input_ids = None
             for _ in range(predict_size):
                 if beam.done():
                     break
+                check(cancel_token)
                 input_ids = beam.getCurrentState()
                 outputs = model(input_ids, past_key_values=past_hidden)
                 out = m(outputs[0][:, -1, :]).data
@@ -204,18 +116,21 @@ def codegpt_predict(left_context: str, right_context: str) -> List[str]:
             hyp = beam.getHyp(beam.getFinal())
             pred = beam.buildTargetTokens(hyp)[:beam_size]
 
-            pred = [torch.cat([x.view(-1) for x in p] + [zero] * (100 - len(p))).view(1, -1) for p in pred]
+            pred = [torch.tensor(p + [0] * (100 - len(p)), device=device).view(1, -1) for p in pred]
             p.append(torch.cat(pred, 0).unsqueeze(0))
         p = torch.cat(p, 0)
         for pred in p:
             t = pred[0].cpu().numpy()
             t = t.tolist()
-            if 0 in t:
-                t = t[:t.index(0)]
-            if tokenizer.eos_token_id in t:
-                t = t[:t.index(tokenizer.eos_token_id)]
-            if tokenizer.sep_token_id in t:
-                t = t[:t.index(tokenizer.sep_token_id)]
-            text = DecodeIds(t).strip()
-            return [text]
+            return [postprocess(t)]
     return []
+
+
+def postprocess(t: List[int]) -> str:
+    if 0 in t:
+        t = t[:t.index(0)]
+    if tokenizer.eos_token_id in t:
+        t = t[:t.index(tokenizer.eos_token_id)]
+    if tokenizer.sep_token_id in t:
+        t = t[:t.index(tokenizer.sep_token_id)]
+    return DecodeIds(t).strip()
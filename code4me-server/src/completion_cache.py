@@ -0,0 +1,83 @@
+import os, sys, time, hashlib, threading
+
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional
+
+''' Exact-match cache of completions in front of each model's generate function. Keys are built
+    from the token window the model actually sees, so e.g. an idle trigger firing after an auto
+    trigger at the same position is served without running the model again. '''
+
+COMPLETION_CACHE_MAX_MB = int(os.getenv('COMPLETION_CACHE_MAX_MB', 64))
+COMPLETION_CACHE_TTL = float(os.getenv('COMPLETION_CACHE_TTL', 300))  # seconds
+
+
+def cache_key(model_name: str, *token_windows: Iterable[int]) -> tuple:
+    ''' Digest of the token windows, such that we don't keep ~1000 ints around per entry '''
+    digest = hashlib.blake2b(digest_size=16)
+    for window in token_windows:
+        digest.update(array('q', window).tobytes())
+        digest.update(b'|')
+    return model_name, digest.digest()
+
+
+def entry_nbytes(key: tuple, value: List[str]) -> int:
+    return sys.getsizeof(key) + sum(sys.getsizeof(x) for x in key) \
+        + sys.getsizeof(value) + sum(sys.getsizeof(x) for x in value)
+
+
+class CompletionCache:
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.n_bytes = 0
+        self.entries = OrderedDict()  # key -> (expiry, value, n_bytes), in LRU order
+        self.lock = threading.Lock()
+
+        self.hits, self.misses = 0, 0
+
+    def get(self, key: tuple) -> Optional[List[str]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._evict(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def put(self, key: tuple, value: List[str]):
+        n_bytes = entry_nbytes(key, value)
+        with self.lock:
+            if key in self.entries:
+                self._evict(key)
+            self.entries[key] = (time.monotonic() + self.ttl, list(value), n_bytes)
+            self.n_bytes += n_bytes
+
+            while self.n_bytes > self.max_bytes:
+                self._evict(next(iter(self.entries)))
+
+    def get_or_compute(self, key: tuple, compute: Callable[[], List[str]]) -> List[str]:
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                    'entries': len(self.entries), 'bytes': self.n_bytes}
+
+    def _evict(self, key: tuple):
+        self.n_bytes -= self.entries.pop(key)[2]
+
+
+completion_cache = CompletionCache(COMPLETION_CACHE_MAX_MB * 1024 * 1024, COMPLETION_CACHE_TTL)
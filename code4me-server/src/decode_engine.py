@@ -0,0 +1,217 @@
+import queue, threading, traceback, torch
+
+from concurrent.futures import Future
+from typing import List, Optional, Tuple, Iterable
+from prefix_cache import prefix_cache
+from cancellation import CancellationToken, Cancelled
+
+''' Continuous-batching greedy decoder shared by CodeGPT and UniXcoder.
+    Requests are put on a queue, and a single thread per model advances every active
+    sequence by one token per batched forward pass. Sequences join after their prefill,
+    and leave as soon as they hit a stop token or their token budget. '''
+
+Past = List[List[torch.Tensor]]  # per layer [key, value], each of shape (B, H, L, D)
+
+
+class DecodeAdapter:
+    ''' Model-specific part of the engine. Subclasses implement `prefill` and `step`. '''
+
+    # position of the first token, i.e. RoBERTa starts counting at padding_idx + 1
+    position_offset = 0
+
+    def prefill(self, input_ids: torch.LongTensor, past: Optional[Past] = None) -> Tuple[Past, Optional[torch.Tensor]]:
+        ''' Encode a (1, L) prompt, continuing from the cached `past` of its first tokens if given.
+            Return the past key values of the whole prompt and, if the model predicts the first token
+            from the prompt's last hidden state, the (1, V) logits for that token.
+            Otherwise, return None and the last prompt token is fed as the first decode input. '''
+        raise NotImplementedError
+
+    def step(self, input_ids: torch.LongTensor, past: Past, attention_mask: torch.Tensor,
+             position_ids: torch.LongTensor) -> Tuple[torch.Tensor, Past]:
+        ''' Advance a (B, 1) batch by one token. `attention_mask` is (B, L + 1), with 0 for padding.
+            Return the (B, V) next-token logits, and the updated past key values. '''
+        raise NotImplementedError
+
+
+class DecodeRequest:
+    ''' A single sequence in the engine. '''
+
+    def __init__(self, input_ids: List[int], max_new_tokens: int, stop_ids: Iterable[int], eos_ids: Iterable[int],
+                 session: Optional[str] = None, cancel_token: Optional[CancellationToken] = None):
+        self.input_ids = input_ids
+        self.max_new_tokens = max_new_tokens
+        self.session = session          # key for reusing the prompt's kv cache across requests
+        self.cancel_token = cancel_token
+        self.stop_ids = set(stop_ids)   # included in the output
+        self.eos_ids = set(eos_ids)     # excluded from the output
+        self.future = Future()
+
+        self.generated = []
+        self.next_token = None
+        self.length = 0                 # number of real (unpadded) positions in the kv cache
+
+    def emit(self, token: int) -> bool:
+        ''' Record a generated token, returning whether the sequence is finished. '''
+        if token in self.eos_ids:
+            return True
+        self.generated.append(token)
+        self.next_token = token
+        return token in self.stop_ids or len(self.generated) >= self.max_new_tokens
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_token is not None and self.cancel_token.cancelled
+
+
+class DecodeEngine:
+
+    def __init__(self, name: str, adapter: DecodeAdapter, device: torch.device, max_batch_size: int = 8):
+        self.name = name
+        self.adapter = adapter
+        self.device = device
+        self.max_batch_size = max_batch_size
+
+        self.requests = queue.Queue()
+        self.active: List[DecodeRequest] = []
+        self.past: Optional[Past] = None
+        self.pads: Optional[torch.Tensor] = None  # left-padding per row of self.past
+
+        self.thread = threading.Thread(target=self._run, name=f'{name}-decode-engine', daemon=True)
+        self.thread.start()
+
+    def submit(self, input_ids: List[int], max_new_tokens: int, stop_ids: Iterable[int] = (),
+               eos_ids: Iterable[int] = (), session: Optional[str] = None,
+               cancel_token: Optional[CancellationToken] = None) -> Future:
+        ''' Queue a prompt for generation. The future resolves to the list of generated token ids,
+            or raises `Cancelled` if the sequence is cancelled before it finishes. '''
+        request = DecodeRequest(input_ids, max_new_tokens, stop_ids, eos_ids, session, cancel_token)
+        self.requests.put(request)
+        return request.future
+
+    def generate(self, input_ids: List[int], max_new_tokens: int, stop_ids: Iterable[int] = (),
+                 eos_ids: Iterable[int] = (), session: Optional[str] = None,
+                 cancel_token: Optional[CancellationToken] = None) -> List[int]:
+        return self.submit(input_ids, max_new_tokens, stop_ids, eos_ids, session, cancel_token).result()
+
+    def _run(self):
+        while True:
+            try:
+                with torch.no_grad():
+                    self._admit()
+                    if self.active:
+                        self._step()
+            except Exception as e:
+                # a failing batch should not take down the engine, so fail every active sequence instead
+                traceback.print_exc()
+                for request in self.active:
+                    request.future.set_exception(e)
+                self.active, self.past, self.pads = [], None, None
+
+    def _admit(self):
+        ''' Prefill waiting requests and merge them into the running batch.
+            Blocks when there is nothing to decode. '''
+
+        while len(self.active) < self.max_batch_size:
+            try:
+                request = self.requests.get(block=not self.active)
+            except queue.Empty:
+                return
+
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            if request.cancelled:
+                request.future.set_exception(Cancelled())
+                continue
+
+            try:
+                self._prefill(request)
+            except Exception as e:
+                request.future.set_exception(e)
+
+    def _prefill(self, request: DecodeRequest):
+        cache_key = (self.name, request.session)
+        cached = prefix_cache.lookup(cache_key, request.input_ids) if request.session is not None else None
+        n_cached, cached_past = cached if cached is not None else (0, None)
+
+        # only the tokens after the longest common prefix with the session's last prompt are encoded
+        input_ids = torch.tensor([request.input_ids[n_cached:]], device=self.device)
+        past, logits = self.adapter.prefill(input_ids, cached_past)
+        request.length = len(request.input_ids)
+
+        if request.session is not None:
+            prefix_cache.store(cache_key, request.input_ids, past)
+
+        if logits is None:
+            request.next_token = request.input_ids[-1]
+        elif request.emit(logits.argmax(-1).item()):
+            request.future.set_result(request.generated)
+            return
+
+        self._join(request, past)
+
+    def _join(self, request: DecodeRequest, past: Past):
+        ''' Left-pad either the batch cache or the new cache so their lengths match, and concatenate. '''
+
+        if self.past is None:
+            self.past, self.pads = past, torch.zeros(1, dtype=torch.long, device=self.device)
+            self.active.append(request)
+            return
+
+        batch_length, new_length = self.past[0][0].size(2), past[0][0].size(2)
+        if batch_length < new_length:
+            self.past = [[pad_left(x, new_length - batch_length) for x in layer] for layer in self.past]
+            self.pads += new_length - batch_length
+        elif new_length < batch_length:
+            past = [[pad_left(x, batch_length - new_length) for x in layer] for layer in past]
+
+        self.past = [[torch.cat((x, y), dim=0) for x, y in zip(layer, new_layer)]
+                     for layer, new_layer in zip(self.past, past)]
+        self.pads = torch.cat((self.pads, torch.tensor([max(0, batch_length - new_length)], device=self.device)))
+        self.active.append(request)
+
+    def _step(self):
+        length = self.past[0][0].size(2)
+        input_ids = torch.tensor([[r.next_token] for r in self.active], device=self.device)
+        position_ids = torch.tensor([[self.adapter.position_offset + r.length] for r in self.active], device=self.device)
+        attention_mask = (torch.arange(length + 1, device=self.device).unsqueeze(0) >= self.pads.unsqueeze(1)).long()
+
+        logits, self.past = self.adapter.step(input_ids, self.past, attention_mask, position_ids)
+        tokens = logits.argmax(-1).tolist()
+
+        keep = []
+        for i, (request, token) in enumerate(zip(self.active, tokens)):
+            request.length += 1
+            if request.emit(token):
+                request.future.set_result(request.generated)
+            elif request.cancelled:
+                # leaves the batch at the next token, like a finished sequence
+                request.future.set_exception(Cancelled())
+            else:
+                keep.append(i)
+
+        if len(keep) < len(self.active):
+            self._leave(keep)
+
+    def _leave(self, keep: List[int]):
+        ''' Drop finished rows from the batch, and trim padding columns no remaining row needs. '''
+
+        self.active = [self.active[i] for i in keep]
+        if not self.active:
+            self.past, self.pads = None, None
+            return
+
+        index = torch.tensor(keep, device=self.device)
+        self.pads = self.pads.index_select(0, index)
+        trim = self.pads.min().item()
+        self.pads -= trim
+        self.past = [[x.index_select(0, index)[:, :, trim:] for x in layer] for layer in self.past]
+
+
+def pad_left(x: torch.Tensor, n: int) -> torch.Tensor:
+    ''' Left-pad a (B, H, L, D) kv tensor with n zero positions '''
+    return torch.cat((x.new_zeros(x.size(0), x.size(1), n, x.size(3)), x), dim=2)
+
+
+def to_past(past_key_values) -> Past:
+    ''' HF returns tuples of tuples, which we want to be able to modify in place '''
+    return [[x for x in layer[:2]] for layer in past_key_values]
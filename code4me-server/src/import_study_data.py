@@ -0,0 +1,107 @@
+import os, json, argparse
+
+from typing import Iterator, List, Tuple
+
+from store import LogStore
+
+''' Imports the completion records that were stored as one JSON file per completion into the log stores:
+    data_aral/<user_uuid>/<verify_token>.json (v2) into data_aral/store, and data/<user_token>-<verify_token>.json
+    (v1) into data/store. Tokens that are already in a store are skipped, so an interrupted import can be rerun
+    (only the records of filtered requests, which have no verify token, are imported again). Completions that
+    were verified in place (with 'ground_truth' in v2 and 'groundTruth' in v1) are also marked as verified.
+    Run it while the server is stopped, as the stores are not meant to be written by two processes at once.
+
+    python import_study_data.py --study-dir data_aral --v1-dir data '''
+
+
+def study_files(study_dir: str):
+    ''' (user_uuid, verify_token, path) of the files in `study_dir`/user_uuid/verify_token.json '''
+    for user_entry in os.scandir(study_dir):
+        if not user_entry.is_dir() or user_entry.name == 'store':
+            continue
+        for entry in os.scandir(user_entry.path):
+            if entry.is_file() and entry.name.endswith('.json'):
+                yield user_entry.name, entry.name[:-len('.json')], entry.path
+
+
+def v1_files(v1_dir: str):
+    ''' (user_token, verify_token, path) of the files in `v1_dir`/user_token-verify_token.json '''
+    for entry in os.scandir(v1_dir):
+        if entry.is_file() and entry.name.endswith('.json') and '-' in entry.name:
+            user_token, _, verify_token = entry.name[:-len('.json')].rpartition('-')
+            yield user_token, verify_token, entry.path
+
+
+def logged_requests(data_dir: str) -> Iterator[dict]:
+    ''' The data of the v2 completions logged in `data_dir`: the records of its store, followed by the files of
+        completions that were not imported into it yet. The store is opened read-only, so this can run next to
+        the server. '''
+
+    store_dir = os.path.join(data_dir, 'store')
+    store = LogStore(store_dir, read_only=True) if os.path.isdir(store_dir) else None
+    if store is not None:
+        for record in store.records():
+            if 'data' in record:  # not a verify record
+                yield record['data']
+
+    for _, token, path in study_files(data_dir):
+        # whether a filtered request (without a verify token) was imported is unknown, so once there is a
+        # store, only the store's are used
+        if store is not None and (not token or token in store):
+            continue
+        try:
+            with open(path) as f:
+                yield json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+
+
+def load_requests(data_dir: str, limit: int, keys: Tuple[str, ...]) -> List[dict]:
+    ''' Up to `limit` logged requests that have all of `keys`, with only those keys. Used by the tools that
+        replay logged requests. '''
+
+    requests = []
+    for request_json in logged_requests(data_dir):
+        if all(key in request_json for key in keys):
+            requests.append({key: request_json[key] for key in keys})
+        if len(requests) >= limit:
+            break
+    return requests
+
+
+def import_files(store: LogStore, files, verified_key: str) -> dict:
+    stats = {'imported': 0, 'verified': 0, 'skipped': 0, 'unreadable': 0}
+    for user, token, path in files:
+        # filtered v2 requests were all stored as the user's `.json`, without a verify token
+        if token and token in store:
+            stats['skipped'] += 1
+            continue
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            stats['unreadable'] += 1
+            continue
+        store.append(user, token, data)
+        stats['imported'] += 1
+        if token and verified_key in data:
+            # the ground truth is already in the completion, so the verify payload is empty
+            store.verify(user, token, {})
+            stats['verified'] += 1
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import per-completion JSON files into the log stores')
+    parser.add_argument('--study-dir', default='data_aral')
+    parser.add_argument('--v1-dir', default='data')
+    args = parser.parse_args()
+
+    if os.path.isdir(args.study_dir):
+        store = LogStore(os.path.join(args.study_dir, 'store'), chunked_fields=('prefix', 'suffix'))
+        stats = import_files(store, study_files(args.study_dir), 'ground_truth')
+        print(f'{args.study_dir}: {stats}')
+    if os.path.isdir(args.v1_dir):
+        store = LogStore(os.path.join(args.v1_dir, 'store'), chunked_fields=('leftContext', 'rightContext'))
+        stats = import_files(store, v1_files(args.v1_dir), 'groundTruth')
+        print(f'{args.v1_dir}: {stats}')
@@ -1,6 +1,9 @@
 import os
 import util
 from typing import List
+from completion_cache import completion_cache, cache_key
+from tokenization import tail_token_ids, head_token_ids
+from cancellation import CancellationToken, check
 
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer, StoppingCriteriaList, StoppingCriteria
@@ -18,6 +21,9 @@ CUDA = os.getenv("CODE4ME_CUDA", "False") == "True"
 if CUDA:
     model = model.half()
 
+# greedy decoding instead of sampling, which also makes completions safe to cache
+DETERMINISTIC = os.getenv("INCODER_DETERMINISTIC", "False") == "True"
+
 # signals the start of a document
 BOS = "<|endoftext|>"
 # signals the end of a generated infill
@@ -33,20 +39,41 @@ def make_sentinel(i):
     return f"<|mask:{i}|>"
 
 
+def token_ids(text: str) -> List[int]:
+    return tokenizer(text, add_special_tokens=False).input_ids
+
+
+def strip_bos(ids: List[int]) -> List[int]:
+    return ids[1:] if len(ids) > 0 and ids[0] == tokenizer.bos_token_id else ids
+
+
+SENTINEL_0, SENTINEL_1 = token_ids(make_sentinel(0)), token_ids(make_sentinel(1))
+MAX_CONTEXT_TOKENS = 2000
+# EOF is plain text, so it can merge with the last characters of the right context (e.g. `)<|`)
+EOF_MARGIN = 8
+
+
 class StatementStoppingCriteria(StoppingCriteria):
 
     def __init__(self, init_length: int, stop_tokens: List[int]):
         self.init_length = init_length
-        self.stop_tokens = stop_tokens
+        self.stop_tokens = torch.tensor(stop_tokens, device=device)
 
-    def __contains_stop_token(self, tokens):
-        for token in tokens:
-            if token in self.stop_tokens:
-                return True
-        return False
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        # called after every generated token, so only the newest one can be a new stop token
+        if input_ids.size(-1) <= self.init_length:
+            return False
+        return torch.isin(input_ids[0, -1], self.stop_tokens).item()
+
+
+class CancellationCriteria(StoppingCriteria):
+    ''' Stops generation once the request is cancelled, `predict_tokens` then raises `Cancelled` '''
+
+    def __init__(self, cancel_token: CancellationToken):
+        self.cancel_token = cancel_token
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        return self.__contains_stop_token(input_ids[0][self.init_length:])
+        return self.cancel_token.cancelled
 
 
 def decode(tokens):
@@ -57,38 +84,53 @@ def decode(tokens):
     )
 
 
-def generate(left_context: str, right_context: str):
-    left_context_tokenised = tokenizer(left_context, return_tensors="pt").to(device).input_ids[0]
-    right_context_tokenised = tokenizer(right_context, return_tensors="pt").to(device).input_ids[0]
+def generate(left_context: str, right_context: str, session: str = None, cancel_token: CancellationToken = None):
+    # neither context is ever given more than MAX_CONTEXT_TOKENS, so we need not tokenize beyond that
+    left_context_tokenised = [tokenizer.bos_token_id] + tail_token_ids(tokenizer, left_context, MAX_CONTEXT_TOKENS)
+    right_context_tokenised = [tokenizer.bos_token_id] + head_token_ids(tokenizer, right_context, MAX_CONTEXT_TOKENS)
 
-    left_context = decode(util.truncate_left_context(
+    # the infill prompt is built from the token ids directly, instead of decoding the truncated
+    # contexts to text, and tokenising the prompt string again
+    left_ids = strip_bos(util.truncate_left_context(
         left_context_tokenised,
         max(1000, 2000 - len(right_context_tokenised))
     ))
 
-    right_context = decode(util.truncate_right_context(
+    right_ids = strip_bos(util.truncate_right_context(
         right_context_tokenised,
         max(1000, 2000 - len(left_context_tokenised))
     ))
 
-    prompt = left_context + make_sentinel(0) + right_context + EOF + make_sentinel(1) + make_sentinel(0)
-    tokens = tokenizer(prompt, return_tensors="pt")
-    if CUDA:
-        tokens = tokens.to(device)
-    token_count = len(tokens.input_ids[0])
+    # only the boundary with EOF is tokenised again
+    right_ids = right_ids[:max(0, len(right_ids) - EOF_MARGIN)] \
+        + token_ids(decode(right_ids[-EOF_MARGIN:]) + EOF)
+
+    prompt_ids = [tokenizer.bos_token_id] + left_ids + SENTINEL_0 + right_ids + SENTINEL_1 + SENTINEL_0
+    input_ids = torch.tensor([prompt_ids], device=device)
+    tokens = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+    token_count = len(prompt_ids)
+
+    if DETERMINISTIC:
+        return completion_cache.get_or_compute(cache_key("InCoder", prompt_ids),
+                                               lambda: predict_tokens(tokens, token_count, cancel_token))
+    return predict_tokens(tokens, token_count, cancel_token)
+
 
+def predict_tokens(tokens, token_count: int, cancel_token: CancellationToken = None) -> List[str]:
     stopping_criteria = StoppingCriteriaList()
     stopping_criteria.append(StatementStoppingCriteria(token_count, stop_tokens))
+    if cancel_token is not None:
+        stopping_criteria.append(CancellationCriteria(cancel_token))
 
     with torch.no_grad():
+        sampling = {"do_sample": False} if DETERMINISTIC else {"do_sample": True, "top_p": 0.95, "temperature": 0.2}
         completion = model.generate(
             **tokens,
-            do_sample=True,
-            top_p=0.95,
-            temperature=0.2,
+            **sampling,
             max_length=min(2048, token_count + 48),
             stopping_criteria=stopping_criteria
         )[0][token_count:]
+    check(cancel_token)
 
     decoded_completion = decode(completion).strip().split("\n")[0]
     return [decoded_completion]
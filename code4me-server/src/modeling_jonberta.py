@@ -149,6 +149,17 @@ use_queries = 'use_queries' # bool
 
 # TODO: add proper error handling if any of these are missing 
 
+# fused attention kernel for SelfAttention. torch>=2.0 has `scaled_dot_product_attention`, and the pinned torch 1.13
+# has it as `_scaled_dot_product_attention`, which takes the same additive mask but also returns the attention weights
+if hasattr(nn.functional, 'scaled_dot_product_attention'):
+    fused_attention = nn.functional.scaled_dot_product_attention
+elif hasattr(nn.functional, '_scaled_dot_product_attention'):
+    def fused_attention(query, key, value, attn_mask=None, dropout_p=0.0):
+        return nn.functional._scaled_dot_product_attention(query, key, value, attn_mask, dropout_p, False, False)[0]
+else:
+    fused_attention = None
+FUSED_ATTENTION = fused_attention is not None
+
 class Hadamard(nn.Module):
     '''
     Oh yeah baby, we have to make our own module for something as simple as element-wise multiplication 
@@ -276,6 +287,23 @@ class JonbertaEncoder(RobertaEncoder):
         return_dict: Optional[bool] = True,
     ) -> Union[Tuple[torch.Tensor], BaseModelOutputWithPastAndCrossAttentions]:
 
+        encoder_hidden_states = self.prepare_features(encoder_hidden_states)
+        return super().forward(
+            hidden_states,
+            attention_mask=attention_mask,
+            head_mask=head_mask,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            past_key_values=past_key_values,
+            use_cache=use_cache,
+            output_attentions=output_attentions,
+            output_hidden_states=output_hidden_states,
+            return_dict=return_dict,
+        )
+
+    def prepare_features(self, encoder_hidden_states: Optional[torch.FloatTensor]) -> Optional[torch.FloatTensor]:
+        ''' Turn the telemetry features into what the layers attend to '''
+
         if self.config.get(add_feature_embeddings):
             encoder_hidden_states = self.feature_embeddings(encoder_hidden_states)
 
@@ -291,19 +319,7 @@ class JonbertaEncoder(RobertaEncoder):
             encoder_keys = self.shared_keys(encoder_hidden_states).unsqueeze(1)
             raise NotImplementedError('Shared keys (self-attn) not implemented yet')
 
-        
-        return super().forward(
-            hidden_states,
-            attention_mask=attention_mask,
-            head_mask=head_mask,
-            encoder_hidden_states=encoder_hidden_states,
-            encoder_attention_mask=encoder_attention_mask,
-            past_key_values=past_key_values,
-            use_cache=use_cache,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=return_dict,
-        )
+        return encoder_hidden_states
 
 class JonbertaLayer(nn.Module):
     ''' Layer with following potential additions: 
@@ -521,45 +537,54 @@ class SelfAttention(nn.Module):
 
         use_cache = past_key_value is not None # should be None, not a decoder model 
 
-        # Take the dot product between "query" and "key" to get the raw attention scores.
-        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+        # the fused kernel cannot add relative position scores, mask heads, or return the attention probabilities
+        if FUSED_ATTENTION and self.position_embedding_type == "absolute" and head_mask is None and not output_attentions:
+            context_layer = fused_attention(
+                query_layer, key_layer, value_layer, attn_mask=attention_mask, 
+                dropout_p=self.dropout.p if self.training else 0.0,
+            )
+            attention_probs = None
 
-        if self.position_embedding_type == "relative_key" or self.position_embedding_type == "relative_key_query":
-            query_length, key_length = query_layer.shape[2], key_layer.shape[2]
-            if use_cache:
-                position_ids_l = torch.tensor(key_length - 1, dtype=torch.long, device=hidden_states.device).view(
-                    -1, 1
-                )
-            else:
-                position_ids_l = torch.arange(query_length, dtype=torch.long, device=hidden_states.device).view(-1, 1)
-            position_ids_r = torch.arange(key_length, dtype=torch.long, device=hidden_states.device).view(1, -1)
-            distance = position_ids_l - position_ids_r
-
-            positional_embedding = self.distance_embedding(distance + self.max_position_embeddings - 1)
-            positional_embedding = positional_embedding.to(dtype=query_layer.dtype)  # fp16 compatibility
-
-            if self.position_embedding_type == "relative_key":
-                relative_position_scores = torch.einsum("bhld,lrd->bhlr", query_layer, positional_embedding)
-                attention_scores = attention_scores + relative_position_scores
-            elif self.position_embedding_type == "relative_key_query":
-                relative_position_scores_query = torch.einsum("bhld,lrd->bhlr", query_layer, positional_embedding)
-                relative_position_scores_key = torch.einsum("bhrd,lrd->bhlr", key_layer, positional_embedding)
-                attention_scores = attention_scores + relative_position_scores_query + relative_position_scores_key
-
-        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
-        if attention_mask is not None:
-            # Apply the attention mask is (precomputed for all layers in RobertaModel forward() function)
-            attention_scores = attention_scores + attention_mask
+        else:
+            # Take the dot product between "query" and "key" to get the raw attention scores.
+            attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
+
+            if self.position_embedding_type == "relative_key" or self.position_embedding_type == "relative_key_query":
+                query_length, key_length = query_layer.shape[2], key_layer.shape[2]
+                if use_cache:
+                    position_ids_l = torch.tensor(key_length - 1, dtype=torch.long, device=hidden_states.device).view(
+                        -1, 1
+                    )
+                else:
+                    position_ids_l = torch.arange(query_length, dtype=torch.long, device=hidden_states.device).view(-1, 1)
+                position_ids_r = torch.arange(key_length, dtype=torch.long, device=hidden_states.device).view(1, -1)
+                distance = position_ids_l - position_ids_r
 
-        # Normalize the attention scores to probabilities.
-        attention_probs = nn.functional.softmax(attention_scores, dim=-1)
-        attention_probs = self.dropout(attention_probs)
+                positional_embedding = self.distance_embedding(distance + self.max_position_embeddings - 1)
+                positional_embedding = positional_embedding.to(dtype=query_layer.dtype)  # fp16 compatibility
 
-        # Mask heads if we want to
-        if head_mask is not None: 
-            attention_probs = attention_probs * head_mask
+                if self.position_embedding_type == "relative_key":
+                    relative_position_scores = torch.einsum("bhld,lrd->bhlr", query_layer, positional_embedding)
+                    attention_scores = attention_scores + relative_position_scores
+                elif self.position_embedding_type == "relative_key_query":
+                    relative_position_scores_query = torch.einsum("bhld,lrd->bhlr", query_layer, positional_embedding)
+                    relative_position_scores_key = torch.einsum("bhrd,lrd->bhlr", key_layer, positional_embedding)
+                    attention_scores = attention_scores + relative_position_scores_query + relative_position_scores_key
 
-        context_layer = torch.matmul(attention_probs, value_layer)
+            attention_scores = attention_scores / math.sqrt(self.attention_head_size)
+            if attention_mask is not None:
+                # Apply the attention mask is (precomputed for all layers in RobertaModel forward() function)
+                attention_scores = attention_scores + attention_mask
+
+            # Normalize the attention scores to probabilities.
+            attention_probs = nn.functional.softmax(attention_scores, dim=-1)
+            attention_probs = self.dropout(attention_probs)
+
+            # Mask heads if we want to
+            if head_mask is not None: 
+                attention_probs = attention_probs * head_mask
+
+            context_layer = torch.matmul(attention_probs, value_layer)
 
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
@@ -568,23 +593,30 @@ class SelfAttention(nn.Module):
         # NOTE: Custom dual-attention to features (encoder_hidden_states)
         if encoder_hidden_states is not None:
 
-            if self.f_key is not None: # no shared keys
-                encoder_key_layer = self.transpose_for_scores(self.f_key(encoder_hidden_states))
-            if self.f_value is not None: 
-                encoder_value_layer = self.transpose_for_scores(self.f_value(encoder_hidden_states))
+            single_key = encoder_hidden_states.dim() == 3 and encoder_hidden_states.size(1) == 1 
+            if single_key and self.f_value is not None and not self.training:
+                # softmax over a single feature key is always 1, so every token gets the feature value. 
+                # Skips the key projection and the score matmul, and gives the exact same result
+                encoder_context_layer = self.f_value(encoder_hidden_states).expand_as(context_layer)
+
+            else: 
+                if self.f_key is not None: # no shared keys
+                    encoder_key_layer = self.transpose_for_scores(self.f_key(encoder_hidden_states))
+                if self.f_value is not None: 
+                    encoder_value_layer = self.transpose_for_scores(self.f_value(encoder_hidden_states))
 
-            # using the same token emb queries, we compute attention scores to our feature keys
-            encoder_attention_scores = torch.matmul(query_layer, encoder_key_layer.transpose(-1, -2))
-            encoder_attention_scores = encoder_attention_scores / math.sqrt(self.attention_head_size)
+                # using the same token emb queries, we compute attention scores to our feature keys
+                encoder_attention_scores = torch.matmul(query_layer, encoder_key_layer.transpose(-1, -2))
+                encoder_attention_scores = encoder_attention_scores / math.sqrt(self.attention_head_size)
 
-            encoder_attention_probs = nn.functional.softmax(encoder_attention_scores, dim=-1)
-            encoder_attention_probs = self.dropout(encoder_attention_probs)
+                encoder_attention_probs = nn.functional.softmax(encoder_attention_scores, dim=-1)
+                encoder_attention_probs = self.dropout(encoder_attention_probs)
 
-            encoder_context_layer = torch.matmul(encoder_attention_probs, encoder_value_layer)
+                encoder_context_layer = torch.matmul(encoder_attention_probs, encoder_value_layer)
 
-            encoder_context_layer = encoder_context_layer.permute(0, 2, 1, 3).contiguous()
-            new_context_layer_shape = encoder_context_layer.size()[:-2] + (self.all_head_size,)
-            encoder_context_layer = encoder_context_layer.view(new_context_layer_shape)
+                encoder_context_layer = encoder_context_layer.permute(0, 2, 1, 3).contiguous()
+                new_context_layer_shape = encoder_context_layer.size()[:-2] + (self.all_head_size,)
+                encoder_context_layer = encoder_context_layer.view(new_context_layer_shape)
 
             # naively add these to the code context layer, as this is what is done to the residual
             # `hidden_states` in the original SelfOutput module anyway. 
@@ -763,6 +795,13 @@ class ScaledCrossAttention(nn.Module):
         else: 
             value_layer = encoder_hidden_states
 
+        # with a single feature to attend to, softmax gives it all the attention, so every token's context 
+        # is that feature's value. Skips the query projection and softmax, and gives the exact same result
+        if value_layer.size(-2) == 1 and not self.training and not output_attentions \
+                and encoder_attention_mask is None and head_mask is None: 
+            context_layer = value_layer.expand(-1, -1, hidden_states.size(1), -1).squeeze(1)
+            return (context_layer, past_key_value)
+
         # weighted sum of features per embedded token vector
         # query_layer = self.transpose_for_scores(self.query(hidden_states))
         mixed_query_layer = self.qk(hidden_states)
@@ -860,9 +899,51 @@ class JonbertaForSequenceClassification(RobertaPreTrainedModel):
 
         self.add_features_in_head = config.get(add_head)
 
+        # {layer_idx: margin} for early-exit inference, see `early_exit`. None runs all layers
+        self.early_exit_thresholds = None
+
         # Initialize weights and apply final processing
         self.post_init()
 
+    def classify(self, sequence_output: torch.Tensor, encoder_hidden_states: Optional[torch.Tensor] = None) -> torch.Tensor:
+        return self.classifier(sequence_output) if not self.add_features_in_head \
+            else self.classifier(sequence_output, telemetry_features=encoder_hidden_states)
+
+    def layer_logits(self, input_ids: torch.LongTensor, attention_mask: Optional[torch.FloatTensor] = None,
+                     encoder_hidden_states: Optional[torch.Tensor] = None):
+        ''' Run the encoder one layer at a time, yielding (layer_idx, logits) with the classification head 
+            applied after every layer. The last logits are the same as those of `forward`. '''
+
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        extended_attention_mask = self.roberta.get_extended_attention_mask(attention_mask, input_ids.shape)
+        features = self.roberta.encoder.prepare_features(encoder_hidden_states)
+
+        hidden_states = self.roberta.embeddings(input_ids=input_ids)
+        for layer_idx, layer in enumerate(self.roberta.encoder.layer):
+            hidden_states = layer(hidden_states, extended_attention_mask, None, features)[0]
+            yield layer_idx, self.classify(hidden_states, encoder_hidden_states)
+
+    def early_exit(self, input_ids: torch.LongTensor, attention_mask: Optional[torch.FloatTensor] = None,
+                   encoder_hidden_states: Optional[torch.Tensor] = None, thresholds: dict = None) -> Tuple[torch.Tensor, int]:
+        ''' Stop after the first layer where the margin between the two most likely labels reaches that layer's 
+            threshold (for all samples in the batch). Samples keep the logits of the layer they were confident at. 
+            Returns the logits and the number of layers that ran. Thresholds come from `calibrate_early_exit.py`. '''
+
+        thresholds = thresholds if thresholds is not None else self.early_exit_thresholds
+        logits, done = None, None
+        for layer_idx, layer_logits in self.layer_logits(input_ids, attention_mask, encoder_hidden_states):
+            if logits is None:
+                logits, done = layer_logits, torch.zeros(layer_logits.size(0), dtype=torch.bool, device=layer_logits.device)
+            logits = torch.where(done.unsqueeze(-1), logits, layer_logits)
+
+            if layer_idx in thresholds:
+                top2 = layer_logits.topk(2, dim=-1).values
+                done |= (top2[:, 0] - top2[:, 1]) >= thresholds[layer_idx]
+                if done.all():
+                    break
+        return logits, layer_idx + 1
+
     def forward(
         self,
         input_ids: Optional[torch.LongTensor] = None,
@@ -886,6 +967,11 @@ class JonbertaForSequenceClassification(RobertaPreTrainedModel):
         """
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
+        if self.early_exit_thresholds and labels is None and inputs_embeds is None \
+                and not output_attentions and not output_hidden_states and head_mask is None:
+            logits, _ = self.early_exit(input_ids, attention_mask, encoder_hidden_states)
+            return SequenceClassifierOutput(logits=logits) if return_dict else (logits,)
+
         outputs = self.roberta(
             input_ids,
             attention_mask=attention_mask,
@@ -899,8 +985,7 @@ class JonbertaForSequenceClassification(RobertaPreTrainedModel):
             return_dict=return_dict,
         )
         sequence_output = outputs[0]
-        logits = self.classifier(sequence_output) if not self.add_features_in_head \
-            else self.classifier(sequence_output, telemetry_features=encoder_hidden_states)
+        logits = self.classify(sequence_output, encoder_hidden_states)
 
         loss = None
         if labels is not None:
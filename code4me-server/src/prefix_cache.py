@@ -0,0 +1,68 @@
+import os, threading
+
+from collections import OrderedDict
+from typing import Hashable, List, Optional, Tuple
+
+''' Session-scoped cache of the past key values of the last prompt per (model, user).
+    Successive keystrokes mostly share all but the last few tokens of the prompt, so the decode
+    engine only has to prefill the tokens after the longest common prefix. Note that this stops
+    helping once a file outgrows the model's window, as the window then slides from the front. '''
+
+PREFIX_CACHE_MAX_MB = int(os.getenv('PREFIX_CACHE_MAX_MB', 1024))
+
+
+def past_nbytes(past) -> int:
+    return sum(x.numel() * x.element_size() for layer in past for x in layer)
+
+
+def common_prefix_length(a: List[int], b: List[int]) -> int:
+    n = min(len(a), len(b))
+    for i in range(n):
+        if a[i] != b[i]:
+            return i
+    return n
+
+
+class PrefixCache:
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.entries = OrderedDict()  # key -> (input_ids, past, n_bytes), in LRU order
+        self.lock = threading.Lock()
+
+        self.hits, self.misses = 0, 0
+
+    def lookup(self, key: Hashable, input_ids: List[int]) -> Optional[Tuple[int, list]]:
+        ''' Return the length of the longest common prefix with the cached prompt, and the cached past
+            trimmed to that length. At least one token is left over, as the model needs an input. '''
+
+        with self.lock:
+            cached_ids, past, _ = self.entries.get(key, ([], None, 0))
+            n = min(common_prefix_length(cached_ids, input_ids), len(input_ids) - 1)
+            if n <= 0:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+        return n, [[x[:, :, :n] for x in layer] for layer in past]
+
+    def store(self, key: Hashable, input_ids: List[int], past):
+        n_bytes = past_nbytes(past)
+        if n_bytes > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.n_bytes -= self.entries.pop(key)[2]
+            self.entries[key] = (input_ids, past, n_bytes)
+            self.n_bytes += n_bytes
+
+            while self.n_bytes > self.max_bytes:
+                _, (_, _, evicted_bytes) = self.entries.popitem(last=False)
+                self.n_bytes -= evicted_bytes
+
+
+prefix_cache = PrefixCache(PREFIX_CACHE_MAX_MB * 1024 * 1024)
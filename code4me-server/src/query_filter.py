@@ -1,12 +1,25 @@
-import os, math, enum, torch, numpy as np
+import os, json, math, enum, time, queue, threading, torch, numpy as np
+
+from concurrent.futures import Future
+from typing import List, Tuple
 
 from modeling_jonberta import JonbertaForSequenceClassification, add_features_to_model
 from transformers import TextClassificationPipeline, AutoTokenizer, AutoConfig
 from safetensors import safe_open
+from tokenization import joint_token_ids
 
 MODELS_DIR = 'models'
 DEVICE = 1 if torch.cuda.is_available() else -1 
 
+# concurrent requests to a transformer filter are classified together, see `BatchedFilter`
+FILTER_MAX_BATCH_SIZE = int(os.getenv('FILTER_MAX_BATCH_SIZE', 16))
+FILTER_BATCH_WINDOW_MS = float(os.getenv('FILTER_BATCH_WINDOW_MS', 2))
+# int8 dynamic quantization of the filters' linear layers, only used when running on CPU
+FILTER_QUANTIZE = os.getenv('FILTER_QUANTIZE', 'False') == 'True'
+# stop at the first layer where the filter is confident enough, using thresholds from `calibrate_early_exit.py`
+FILTER_EARLY_EXIT = os.getenv('FILTER_EARLY_EXIT', 'False') == 'True'
+EARLY_EXIT_FILE = 'early_exit.json'
+
 
 intercept, coef = 3.73303724, np.array([ 0.00860799, -0.03679135, -0.06289737,  0.4488578 , -0.40977991, -0.57503621, -0.41543147,  0.02215769, -0.56694562,  0.62073879, -0.26658544, -0.33758971, -0.19398661,  0.10083877,  0.29011958, 0.01642904,  0.082694  , -0.45812433,  0.19563108,  1.11585148, -0.12549902, -0.03319017,  0.        ,  0.37221593,  0.20887294, 0.59667318, -0.76727645, -2.23206534,  0.        ,  0.        , 0.        ,  0.        , -0.52622741, -1.80321186, -0.65761382, -0.66972758,  0.        , -2.12369698, -3.08559028, -2.64399433, -2.17775627, -0.72525643, -1.94062537, -0.64899621,  0.        , 0.07055691,  0.        ,  0.        ,  0.        ,  0.        , 0.        ,  0.        ,  0.        ,  0.        , -4.80829315, -2.20680964, -3.35584853, -3.23677452,  0.        ,  0.        , 0.16874269,  0.46803166,  0.6497761 ,  0.52477345,  0.5324576 , 0.51661321,  0.33516685,  0.27858223,  0.39369077,  0.1905836 , 0.11973277,  0.3743934 ,  0.40315233,  0.48388634,  0.32372177, 0.6324842 ,  0.09022166,  0.38000563,  0.4746545 ,  0.54397314, 0.22015718,  0.11972259,  0.33946541,  0.29087561,  0.16096189, 0.18354135, -1.20029481,  0.03437284,  0.08835093, -1.75083818, 0.97368022,  0.        ,  1.54601348,  0.72473379,  1.00326585, 1.8238706 ,  2.44167387,  1.74815122,  0.79420007,  1.53473857, 1.08563755,  0.53734968,  0.55176486,  0.98191938,  0.90612076, 1.81525461,  1.21869578,  1.07433351,  0.40708646,  2.276902  , 1.85239634,  2.01438915,  0.77927204,  0.67669704,  0.69432173, 0.72461073,  0.75737211,  0.27126203, -2.08431261, -1.47177109, 0.02996505, -0.47417774,  0.        ,  0.        ,  0.        , 0.        ,  0.        , -0.964373  , -0.84868705, -0.65761382, -1.42460126,  0.        , -1.47293568, -0.94525298, -0.60052356, -1.12780257, -1.92249699, -1.66530837, -0.64899621,  0.        , 0.07055691,  0.        ,  0.        ,  0.        ,  0.        , 0.        ,  0.        ,  0.        ,  0.        , -1.35681768, -0.80897361, -0.16270093, -0.69864107,  0.        ,  0.        , 0.16874269,  0.46803166,  0.6497761 ,  0.52477345,  0.5324576 , 0.51661321,  0.33516685,  0.27858223,  0.39369077,  0.1905836 , 0.11973277,  0.3743934 ,  0.40315233,  0.48388634, -0.0571159 , 0.6324842 ,  0.09022166,  0.38000563,  0.4746545 ,  0.54397314, 0.22015718,  0.11972259,  0.33946541,  0.29087561,  0.16096189, 0.18354135, -1.79744913,  0.03437284,  0.08835093, -1.75083818, 0.97368022,  0.        ,  0.33769289,  0.72473379,  1.00326585, -0.47593682, -0.28913642, -0.47461482,  0.79420007, -1.07146562, 1.08563755,  0.53734968,  0.55176486,  1.25787508,  0.90612076, -0.05355035,  0.74789048,  1.07433351,  0.40708646, -0.71501723, -0.04197237,  0.10833025,  0.77927204,  0.67669704,  0.75031618, 0.72461073,  0.75737211,  0.27126203, -1.3740823 , -1.18380704, 0.02996505, -0.47417774])
 tokenizer = AutoTokenizer.from_pretrained('huggingface/CodeBERTa-small-v1')
@@ -45,34 +58,55 @@ class Logres:
         ''' Converts a supported language to one-hot vector '''
         return [1 if query_lang == lang else 0 for lang in cls.SUPPORTED_LANGS]
 
-    def _preprocess(self, X: dict) -> np.array: 
-        ''' Preprocess a query into a vector of features '''
+    def predict(self, X: dict) -> bool: 
+        return self.predict_batch([X])[0]
 
-        document_length = len(X['prefix']) + len(X['suffix'])
-        offset = len(X['prefix'])
-        offset_percentage = offset / document_length
-        whitespace_after_cursor = 1 if (len(X['suffix']) >= 1 and X['suffix'][0] == ' ') else 0
-        last_prefix_line = X['prefix'].split('\n')[-1]
-        last_prefix_line_stripped = last_prefix_line.rstrip()
+    # Offsets of the feature blocks in the weights: the dense features, the language, and the last character of the
+    # last prefix line, with and without trailing whitespace. Instead of building the one-hot blocks,
+    # `predict_batch` looks up the weight of the one feature that is set in each of them.
+    DENSE = [0, 1, 2, 3, 24, 25, 26]
+    LANG, CHAR, CHAR_STRIPPED = 4, 27, 27 + 95
+    LANG_INDEX = {lang: i for i, lang in enumerate(SUPPORTED_LANGS)}
 
-        return np.array([
-            math.log(1 + X['time_since_last_completion']),
-            math.log(1 + document_length),
-            math.log(1 + offset),
-            offset_percentage,
-            *self.lang_map(X['language']),
-            whitespace_after_cursor,
-            math.log(1 + len(last_prefix_line)),
-            math.log(1 + len(last_prefix_line_stripped)),
-            *self.character_map(last_prefix_line[-1] if len(last_prefix_line) > 0 else chr(0)),
-            *self.character_map(last_prefix_line_stripped[-1] if len(last_prefix_line_stripped) > 0 else chr(0)),
-        ])
+    @classmethod
+    def _features(cls, X: dict) -> tuple:
+        ''' The dense features and the one-hot indices (-1 for none) of a query. Looks at the last line only, 
+            so this takes constant time in the document size. '''
+
+        prefix, suffix = X['prefix'], X['suffix']
+        offset = len(prefix)
+        document_length = offset + len(suffix)
+        last_prefix_line = prefix[prefix.rfind('\n') + 1:]
+        last_prefix_line_stripped = last_prefix_line.rstrip()
 
-    def predict(self, X: dict) -> bool: 
-        X = self._preprocess(X)
-        should_filter = X @ self.weights + self.intercept > 0  # True means positive class
-        # important to wrap this in bool for json serialisation!
-        return not bool(should_filter) # True means to filter out
+        char_index = lambda line: ord(line[-1]) - 32 if len(line) > 0 and 32 <= ord(line[-1]) < 127 else -1
+        return (
+            X['time_since_last_completion'],
+            document_length,
+            offset,
+            offset / document_length,
+            1 if (len(suffix) >= 1 and suffix[0] == ' ') else 0,
+            len(last_prefix_line),
+            len(last_prefix_line_stripped),
+            cls.LANG_INDEX.get(X['language'], -1),
+            char_index(last_prefix_line),
+            char_index(last_prefix_line_stripped),
+        )
+
+    def predict_batch(self, Xs: List[dict]) -> List[bool]:
+        ''' Same as `predict`, for many queries at once '''
+
+        features = np.array([self._features(X) for X in Xs], dtype=np.float64).reshape(-1, 10)
+        dense = features[:, :7]
+        dense[:, [0, 1, 2, 5, 6]] = np.log1p(dense[:, [0, 1, 2, 5, 6]])
+
+        scores = dense @ self.weights[self.DENSE] + self.intercept
+        for offset, indices in zip((self.LANG, self.CHAR, self.CHAR_STRIPPED), features[:, 7:].astype(np.int64).T):
+            scores += np.where(indices >= 0, self.weights[offset + np.maximum(indices, 0)], 0.0)
+
+        # True means positive class, so not filtering out
+        # important to convert to python bools for json serialisation!
+        return (scores <= 0).tolist()
 
 def get_nontextual_features(query) -> list:
     ''' Get the features that could otherwise not be extracted from the context alone '''
@@ -94,28 +128,14 @@ def tokenize_joint_sample(sample, max_suffix_tokens=128):
     ''' For a single sample, tokenize prefix and suffix, separating by </s> sep token. 
     Set max_suffix_tokens to maximal amount of suffix to include, when it exists. '''
 
-    max_length = tokenizer.model_max_length # 512 
-
-    # figure out how many suffix tokens we have (128 max)
-    tokenizer.truncation_side = 'right'
-    suffix = tokenizer(sample['suffix'], padding='do_not_pad', truncation=True, return_tensors='pt',
-                        max_length = max_suffix_tokens + 1) # to accomodate removal of <s>
-
-    n_suffix_tokens = len(suffix['input_ids'][0]) - 1
+    input_ids, attention_mask = joint_token_ids(tokenizer, sample['prefix'], sample['suffix'], 
+                                                max_length=tokenizer.model_max_length, # 512
+                                                max_suffix_tokens=max_suffix_tokens)
 
-    tokenizer.truncation_side = 'left'
-    prefix = tokenizer(sample['prefix'], padding='do_not_pad', truncation=True, return_tensors='pt',
-                    max_length = max_length - n_suffix_tokens)
-
-    n_prefix_tokens = len(prefix['input_ids'][0])
-    tokenizer.truncation_side = 'right'
-    suffix = tokenizer(sample['suffix'], padding='max_length', truncation=True, return_tensors='pt',
-                    max_length = max_length - n_prefix_tokens + 1) # to accomodate removal of <s>
-    
-    suffix['input_ids'] = suffix['input_ids'][:, 1:]
-    suffix['attention_mask'] = suffix['attention_mask'][:, 1:]
-
-    sample.update({k: torch.cat((prefix[k], suffix[k]), dim=1) for k in prefix})
+    sample.update({
+        'input_ids': torch.tensor([input_ids]),
+        'attention_mask': torch.tensor([attention_mask]),
+    })
     return sample
 
 
@@ -159,7 +179,64 @@ class MyPipeline(TextClassificationPipeline):
         prediction = model_outputs.logits.argmax(-1).item() == 1 # 1 is the positive class
         return not bool(prediction) # True means to filter out
 
-def get_model(model_name):
+class BatchedFilter:
+    ''' Runs a `MyPipeline` on micro-batches. Requests that arrive within `window_ms` of the first one 
+        are classified in a single forward pass, padded to the longest of them instead of to 512 tokens. 
+        Samples only have padding at the end, and it is masked out, so the decisions are the pipeline's. '''
+
+    def __init__(self, pipeline: MyPipeline, max_batch_size: int = FILTER_MAX_BATCH_SIZE, 
+                 window_ms: float = FILTER_BATCH_WINDOW_MS):
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __call__(self, request_json: dict) -> bool:
+        future = Future()
+        self.requests.put((request_json, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.requests.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            try:
+                decisions = self.predict_batch([request_json for request_json, _ in batch])
+                for (_, future), decision in zip(batch, decisions):
+                    future.set_result(decision)
+            except BaseException as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+    def predict_batch(self, requests: List[dict]) -> List[bool]:
+        samples = [self.pipeline.preprocess(request_json) for request_json in requests]
+        length = max(int(sample['attention_mask'].sum()) for sample in samples)
+
+        inputs = {}
+        for key in samples[0]:
+            batch = torch.cat([sample[key] for sample in samples])
+            inputs[key] = batch[:, :length] if key in ('input_ids', 'attention_mask') else batch
+        inputs = self.pipeline._ensure_tensor_on_device(inputs, self.pipeline.device)
+
+        with torch.no_grad():
+            logits = self.pipeline.model(**inputs).logits
+        return (logits.argmax(-1) != 1).tolist() # True means to filter out
+
+def batched(pipeline: MyPipeline):
+    return BatchedFilter(pipeline) if FILTER_MAX_BATCH_SIZE > 1 else pipeline
+
+def get_model(model_name, quantize=False):
+    ''' Load a filter model. With `quantize`, its linear layers are replaced by dynamically quantized int8 ones, 
+        which only run on CPU. See `bench_filter_quantization.py` for how this affects latency and decisions. '''
+
     model_dir = os.path.join(MODELS_DIR, model_name)
     config = AutoConfig.from_pretrained(model_dir)
 
@@ -177,8 +254,19 @@ def get_model(model_name):
           I don\'t know why this happens, I can't reproduce it locally 
           As long as it's just embedding position ids, it should be fine.''') 
 
+    if quantize:
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
     return model 
 
+def load_early_exit_thresholds(model_name):
+    ''' The calibrated {layer_idx: margin} thresholds of a filter model, or None if it was not calibrated '''
+
+    file_path = os.path.join(MODELS_DIR, model_name, EARLY_EXIT_FILE)
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path) as f:
+        return {int(layer_idx): margin for layer_idx, margin in json.load(f)['thresholds'].items()}
+
 class Filter(enum.Enum):
     NO_FILTER = 'no_filter'
     FEATURE = 'feature'
@@ -186,25 +274,102 @@ class Filter(enum.Enum):
     JOINT_H = 'joint_h'
     JOINT_A = 'joint_a'
 
+FILTER_MODELS = {
+    Filter.CONTEXT: '12_codeberta-biased-2e-05lr--0',
+    Filter.JOINT_H: '-13_jonberta-biased-12_codeberta-biased-2e-05lr--0-(HEAD-dense--reinit)-2e-05lr-1',
+    Filter.JOINT_A: '13_jonberta-biased-12_codeberta-biased-2e-05lr--0-(ATTN-208C_f-[0]L)-2e-05lr--4',
+}
+
+# comma-separated `Filter` values that users can be assigned, all of them by default
+ENABLED_FILTERS = [Filter(value.strip()) for value in os.getenv('CODE4ME_FILTERS', ','.join(f.value for f in Filter)).split(',') 
+                   if value.strip() != '']
+if len(ENABLED_FILTERS) == 0:
+    raise ValueError('CODE4ME_FILTERS does not enable any filter')
+
+# parameters of the loaded filter models by name, such that weights the checkpoints have in common 
+# (e.g. the CodeBERTa encoder the jonberta models were fine-tuned from, if it was frozen) are kept once
+shared_parameters = {}
+load_lock = threading.Lock()
+
+def share_parameters(model) -> Tuple[int, int]:
+    ''' Replace the model's parameters by identical ones of previously loaded models. 
+        Returns the number of bytes that are shared, and that are the model's own. '''
+
+    shared_bytes, own_bytes = 0, 0
+    for name, param in list(model.named_parameters()):
+        n_bytes = param.numel() * param.element_size()
+        shared = next((p for p in shared_parameters.get(name, []) 
+                       if p.shape == param.shape and p.dtype == param.dtype and torch.equal(p, param.to(p.device))), None)
+        if shared is None:
+            shared_parameters.setdefault(name, []).append(param)
+            own_bytes += n_bytes
+        else:
+            module_name, _, param_name = name.rpartition('.')
+            setattr(model.get_submodule(module_name), param_name, shared)
+            shared_bytes += n_bytes
+    return shared_bytes, own_bytes
+
+class LazyFilter:
+    ''' A transformer filter that is loaded the first time it is called, 
+        so filters that are not enabled, or not assigned yet, take no memory '''
+
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+        self.filter = None
+        self.cost = {'loaded': False}
+
+    def load(self):
+        with load_lock:
+            if self.filter is None:
+                t0 = time.perf_counter()
+                # seeded like the filters that were loaded at startup, without resetting the global RNGs
+                # partway through serving (the weights are initialised on the CPU)
+                with torch.random.fork_rng(devices=[]):
+                    torch.manual_seed(42)
+                    model = get_model(self.model_name, quantize=FILTER_QUANTIZE and DEVICE == -1)
+                shared_bytes, own_bytes = share_parameters(model)
+                if FILTER_EARLY_EXIT:
+                    model.early_exit_thresholds = load_early_exit_thresholds(self.model_name)
+                pipeline = MyPipeline( device=DEVICE, task='text-classification', 
+                                       model=model, incl_features=True, model_name=self.model_name )
+                self.cost = {
+                    'loaded': True,
+                    'load_time': time.perf_counter() - t0,
+                    'own_mb': own_bytes / 2**20,
+                    'shared_mb': shared_bytes / 2**20,
+                }
+                print(f'\tloaded \033[1m{self.model_name}\033[0m in {self.cost["load_time"]:.1f}s, '
+                      f'{self.cost["own_mb"]:.0f}MB own and {self.cost["shared_mb"]:.0f}MB shared parameters')
+                self.filter = batched(pipeline)
+                print(f'\tfilter costs: {json.dumps(filter_costs())}')
+        return self.filter
+
+    def __call__(self, request_json: dict) -> bool:
+        return (self.filter or self.load())(request_json)
+
 no_filter = lambda request_json: True 
 logres = Logres(coef, intercept)
 set_all_seeds() # just in case 
-context_filter = MyPipeline( device=DEVICE, task='text-classification',
-                    model=get_model('12_codeberta-biased-2e-05lr--0'), incl_features=True,
-                    model_name='12_codeberta-biased-2e-05lr--0' )
-set_all_seeds()
-joint_h_filter = MyPipeline( device=DEVICE, task='text-classification',
-                    model=get_model('-13_jonberta-biased-12_codeberta-biased-2e-05lr--0-(HEAD-dense--reinit)-2e-05lr-1'), incl_features=True,
-                    model_name='-13_jonberta-biased-12_codeberta-biased-2e-05lr--0-(HEAD-dense--reinit)-2e-05lr-1' )
-set_all_seeds()
-joint_a_filter = MyPipeline( device=DEVICE, task='text-classification',
-                    model=get_model('13_jonberta-biased-12_codeberta-biased-2e-05lr--0-(ATTN-208C_f-[0]L)-2e-05lr--4'), incl_features=True,
-                    model_name='13_jonberta-biased-12_codeberta-biased-2e-05lr--0-(ATTN-208C_f-[0]L)-2e-05lr--4' )
 
 filters = {
     Filter.NO_FILTER: no_filter, 
     Filter.FEATURE: logres.predict,
-    Filter.CONTEXT: context_filter,
-    Filter.JOINT_H: joint_h_filter,
-    Filter.JOINT_A: joint_a_filter,
+    **{filter_type: LazyFilter(model_name) for filter_type, model_name in FILTER_MODELS.items()},
 }
+filters = {filter_type: filters[filter_type] for filter_type in ENABLED_FILTERS}
+
+def filter_costs() -> dict:
+    ''' What each enabled filter costs in memory (and load time, for the transformer filters) '''
+
+    return {
+        filter_type.value: filter_fn.cost if isinstance(filter_fn, LazyFilter) 
+            else {'loaded': True, 'own_mb': logres.weights.nbytes / 2**20 if filter_type == Filter.FEATURE else 0.0}
+        for filter_type, filter_fn in filters.items()
+    }
+
+if __name__ == '__main__':
+    # load every enabled filter and print what it costs
+    for filter_fn in filters.values():
+        if isinstance(filter_fn, LazyFilter):
+            filter_fn.load()
+    print(json.dumps(filter_costs(), indent=2))
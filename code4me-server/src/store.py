@@ -0,0 +1,661 @@
+import os, re, json, time, zlib, queue, atexit, base64, struct, hashlib, logging, argparse, threading
+
+from collections import Counter, deque
+from typing import Iterator, List, Optional, Tuple
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+''' Append-only storage for completion records. Instead of one small file per completion, records are
+    appended as JSON lines to segment files that are rotated at `STORE_SEGMENT_MAX_MB`, and an index file
+    maps each verify token to the (segment, offset, length) of its latest record.
+
+    Records are written behind: `append` queues them, and a writer thread writes whatever is queued with
+    a single write (and fsync, with `STORE_FSYNC`) per batch. Queued records are readable right away. If a
+    batch fails to be written, the segment and index are truncated to before it, and it is written again, up to
+    `STORE_WRITE_ATTEMPTS` times. After that its records are logged as lost and dropped from the queued records.
+
+    Verifying a completion appends a small verify record with only the verify payload, instead of rewriting
+    the completion. `verify` checks the token and whether it was verified before under the store's lock, so
+    only one of two concurrent verifies of a token succeeds. The verified tokens are kept in memory, and both
+    completion and verify records are in the index file.
+
+    The contexts of a completion (e.g. its prefix and suffix) are split into chunks by `split_chunks`, and
+    stored once per distinct chunk, as chunk records keyed by their hash. Consecutive requests of a user
+    share all but a few chunks, so a completion mostly stores references to chunks that were already written.
+    With `zstandard` installed, chunks are compressed, with the store's dictionary if one was trained
+    (`python store.py <directory> --train-dictionary`, while the server is stopped). `get` and `records`
+    reassemble the contexts. A completion is queued with the chunks it refers to that are not written yet, and
+    they are written right before it, in the same write, so a completion is never stored without its chunks.
+    The locations of all chunks are kept in memory, which takes about 230 bytes per distinct chunk (`stats`
+    reports the number of chunks).
+
+    A record is written before its index entry. So after a crash, the last segment can end in a partial
+    line, and the index in a partial entry, or miss the entries of the last records. `LogStore.recover`
+    truncates both to what was completely written, and indexes the records the index is missing. '''
+
+SEGMENT_MAX_BYTES = int(os.getenv('STORE_SEGMENT_MAX_MB', 64)) * 2**20
+FSYNC = os.getenv('STORE_FSYNC', 'False') == 'True'
+QUEUE_SIZE = int(os.getenv('STORE_QUEUE_SIZE', 10000))   # appending blocks while this many records are queued
+MAX_BATCH_SIZE = int(os.getenv('STORE_MAX_BATCH_SIZE', 1024))
+WRITE_ATTEMPTS = int(os.getenv('STORE_WRITE_ATTEMPTS', 3))
+WRITE_RETRY_SECONDS = 0.5  # doubled after every failed attempt
+
+SEGMENT_FILE = 'segment-{:06d}.ndjson'
+SEGMENT_PATTERN = re.compile(r'segment-(\d{6})\.ndjson')
+INDEX_FILE = 'index.bin'
+# record kind, verify token key, user key, segment, offset, length
+INDEX_ENTRY = struct.Struct('<B16s8sIQI')
+INDEX_READ_ENTRIES = 65536
+COMPLETION, VERIFY, CHUNK = 0, 1, 2
+NO_USER = bytes(8)  # user key of chunk records
+
+CHUNK_MIN_CHARS = int(os.getenv('STORE_CHUNK_MIN_CHARS', 512))
+CHUNK_MAX_CHARS = int(os.getenv('STORE_CHUNK_MAX_CHARS', 8192))
+CHUNK_LINE_MASK = 0x7  # a line ends a chunk if the low bits of its hash are 0, i.e. one in eight lines
+COMPRESS = os.getenv('STORE_COMPRESS', 'True') == 'True' and zstandard is not None
+ZSTD_LEVEL = 3
+DICTIONARY_FILE = 'dictionary-{:03d}.zstd'
+DICTIONARY_PATTERN = re.compile(r'dictionary-(\d{3})\.zstd')
+DICTIONARY_SIZE = 112640
+DICTIONARY_SAMPLES = 20000
+
+logger = logging.getLogger(__name__)
+
+
+def token_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+
+def user_key(user: str) -> bytes:
+    return hashlib.blake2b(user.encode(), digest_size=8).digest()
+
+
+def chunk_key(chunk: str) -> bytes:
+    return hashlib.blake2b(chunk.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+def split_chunks(text: str) -> List[str]:
+    ''' Split text into chunks of whole lines. A chunk ends after a line whose hash matches `CHUNK_LINE_MASK`
+        once it has `CHUNK_MIN_CHARS`, or at `CHUNK_MAX_CHARS`. So a boundary depends on the lines before it
+        since the previous boundary only, and an edit changes the chunk it is in, but not the chunks after
+        the next boundary. The first and last lines are chunks of their own, as the cursor is at one of them. '''
+
+    lines = text.splitlines(keepends=True)
+    if len(lines) <= 2:
+        return lines
+
+    chunks, chunk, size = [lines[0]], [], 0
+    for line in lines[1:-1]:
+        chunk.append(line)
+        size += len(line)
+        if size >= CHUNK_MAX_CHARS or \
+                (size >= CHUNK_MIN_CHARS and zlib.crc32(line.encode('utf-8', 'surrogatepass')) & CHUNK_LINE_MASK == 0):
+            chunks.append(''.join(chunk))
+            chunk, size = [], 0
+    if len(chunk) > 0:
+        chunks.append(''.join(chunk))
+    chunks.append(lines[-1])
+    return chunks
+
+
+class InvalidToken(Exception):
+    ''' The verify token is unknown, or belongs to another user '''
+
+
+class AlreadyVerified(Exception):
+    ''' The completion of the verify token was verified before '''
+
+
+class LogStore:
+
+    def __init__(self, directory: str, segment_max_bytes: int = SEGMENT_MAX_BYTES, fsync: bool = FSYNC,
+                 queue_size: int = QUEUE_SIZE, max_batch_size: int = MAX_BATCH_SIZE,
+                 chunked_fields: Tuple[str, ...] = (), compress: bool = COMPRESS, read_only: bool = False):
+        ''' `chunked_fields` are the fields of the completions' data that are stored as chunks. A `read_only` store
+            leaves the files as they are, so it can read a store that another process (i.e. the server) writes. '''
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.read_only = read_only
+        self.chunked_fields = chunked_fields
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync = fsync
+        self.max_batch_size = max_batch_size
+        self.lock = threading.Lock()        # guards the in-memory state below
+        self.write_lock = threading.Lock()  # guards the files
+        self.enqueue_lock = threading.Lock()  # keeps records queued in the order they are appended
+
+        self.index = {}             # token key -> (segment, offset, length, user key) of the token's latest completion
+        self.pending = {}           # token key -> (line, user key) of the token's latest completion, while it is queued
+        self.verified = {}          # token key -> (segment, offset, length) of the token's verify record
+        self.pending_verified = {}  # token key -> line of the token's verify record, while it is queued
+        self.chunks = {}            # chunk key -> (segment, offset, length) of the chunk's record
+        self.pending_chunks = {}    # chunk key -> [line, number of queued records that refer to it], while unwritten
+        self.counts = Counter()     # user key -> number of completions with a verify token
+        self.recover()
+
+        self.dictionaries = self.load_dictionaries() if zstandard is not None else {}
+        self.dictionary_id = max(self.dictionaries, default=None)
+        self.compressor = self.create_compressor() if compress and not read_only else None
+        if read_only:
+            self.closed = True
+            return
+
+        self.segment_file = open(self.segment_path(self.segment), 'ab')
+        self.offset = self.segment_file.tell()
+        self.index_file = open(os.path.join(directory, INDEX_FILE), 'ab')
+
+        self.metrics = {'flushes': 0, 'records': 0, 'last_batch_size': 0, 'flush_ms_total': 0.0, 'flush_ms_max': 0.0,
+                        'failed_writes': 0, 'failed_records': 0, 'context_chars': 0, 'new_chunk_chars': 0, 'new_chunks': 0, 'reused_chunks': 0}
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.closed = False
+        self.writer = threading.Thread(target=self._write_behind, name=f'{directory}-writer', daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, SEGMENT_FILE.format(segment))
+
+    def segments(self):
+        return sorted(int(match.group(1)) for match in map(SEGMENT_PATTERN.fullmatch, os.listdir(self.directory)) if match)
+
+    def recover(self):
+        ''' Load the index, after truncating the segments and index to what was completely written. A read-only
+            store only loads what was completely written. '''
+
+        segments = self.segments()
+        self.segment = segments[-1] if len(segments) > 0 else 0
+        if len(segments) > 0 and not self.read_only:
+            truncate_partial_line(self.segment_path(self.segment))
+        sizes = {segment: os.path.getsize(self.segment_path(segment)) for segment in segments}
+
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        indexed_size, end = 0, (0, 0)  # bytes of valid index entries, and (segment, offset) they cover
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                valid = True
+                while valid:
+                    data = f.read(INDEX_ENTRY.size * INDEX_READ_ENTRIES)
+                    if len(data) == 0:
+                        break
+                    # a partial entry at the end is left out
+                    for i in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+                        kind, key, user, segment, offset, length = INDEX_ENTRY.unpack_from(data, i)
+                        if offset + length > sizes.get(segment, 0):
+                            valid = False  # an entry for a record that was lost
+                            break
+                        self._index(kind, key, user, segment, offset, length)
+                        indexed_size, end = indexed_size + INDEX_ENTRY.size, (segment, offset + length)
+            if not self.read_only:
+                os.truncate(index_path, indexed_size)
+
+        # records that were written, but not indexed
+        missing = []
+        for segment in segments:
+            if segment < end[0]:
+                continue
+            for offset, line in scan(self.segment_path(segment), end[1] if segment == end[0] else 0):
+                record = json.loads(line)
+                if 'chunk' in record:
+                    entry = (CHUNK, bytes.fromhex(record['chunk']), NO_USER, segment, offset, len(line))
+                elif record.get('token'):
+                    kind = VERIFY if 'verify' in record else COMPLETION
+                    entry = (kind, token_key(record['token']), user_key(record['user']), segment, offset, len(line))
+                else:
+                    continue
+                self._index(*entry)
+                missing.append(INDEX_ENTRY.pack(*entry))
+        if len(missing) > 0 and not self.read_only:
+            print(f'Indexed {len(missing)} records that were missing from {index_path}')
+            with open(index_path, 'ab') as f:
+                f.write(b''.join(missing))
+
+    def load_dictionaries(self) -> dict:
+        dictionaries = {}
+        for file_name in os.listdir(self.directory):
+            match = DICTIONARY_PATTERN.fullmatch(file_name)
+            if match:
+                with open(os.path.join(self.directory, file_name), 'rb') as f:
+                    dictionaries[int(match.group(1))] = zstandard.ZstdCompressionDict(f.read())
+        return dictionaries
+
+    def create_compressor(self):
+        ''' A compressor with the latest dictionary. It is only used while holding `enqueue_lock`, as compressors
+            are not thread-safe. '''
+        if zstandard is None:
+            return None
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=self.dictionaries.get(self.dictionary_id))
+
+    def _index(self, kind: int, key: bytes, user: bytes, segment: int, offset: int, length: int, count: bool = True):
+        if kind == CHUNK:
+            self.chunks[key] = (segment, offset, length)
+            return
+        if kind == VERIFY:
+            self.verified[key] = (segment, offset, length)
+            return
+        if count and key not in self.index:
+            self.counts[user] += 1
+        self.index[key] = (segment, offset, length, user)
+
+    def append(self, user: str, token: str, data: dict):
+        ''' Queue a completion record to be appended, blocking while the queue is full. The latest record of a verify
+            token replaces its earlier ones, records without a verify token (i.e. filtered requests) are stored but
+            not indexed. '''
+
+        contexts = {field: data[field] for field in self.chunked_fields if isinstance(data.get(field), str)}
+        record = {'user': user, 'token': token, 'data': {k: v for k, v in data.items() if k not in contexts}}
+        key, ukey = (token_key(token), user_key(user)) if token else (None, None)
+
+        with self.enqueue_lock:
+            chunks = {}
+            if len(contexts) > 0:
+                record['chunks'] = {field: self._chunk(text, chunks) for field, text in contexts.items()}
+            line = (json.dumps(record) + '\n').encode()
+            with self.lock:
+                for chunk, chunk_line in chunks.items():
+                    self.pending_chunks.setdefault(chunk, [chunk_line, 0])[1] += 1
+                if token:
+                    if key not in self.index and key not in self.pending:
+                        self.counts[ukey] += 1
+                    self.pending[key] = (line, ukey)
+            self._enqueue((COMPLETION, key, ukey, line, tuple(chunks.items())))
+
+    def _chunk(self, text: str, chunks: dict) -> List[str]:
+        ''' The keys of the chunks of `text`, adding the lines of chunks that are not written yet to `chunks` '''
+
+        keys, new_chars, new_chunks = [], 0, 0
+        for chunk in split_chunks(text):
+            key = chunk_key(chunk)
+            keys.append(key.hex())
+            with self.lock:
+                if key in self.chunks or key in chunks:
+                    continue
+                # queued for an earlier record, which can still fail to be written
+                pending = self.pending_chunks.get(key)
+            if pending is None:
+                chunks[key] = self._chunk_line(key, chunk)
+                new_chars, new_chunks = new_chars + len(chunk), new_chunks + 1
+            else:
+                chunks[key] = pending[0]
+
+        with self.lock:
+            self.metrics['context_chars'] += len(text)
+            self.metrics['new_chunk_chars'] += new_chars
+            self.metrics['new_chunks'] += new_chunks
+            self.metrics['reused_chunks'] += len(keys) - new_chunks
+        return keys
+
+    def _chunk_line(self, key: bytes, chunk: str) -> bytes:
+        record = {'chunk': key.hex()}
+        if self.compressor is not None:
+            compressed = base64.b64encode(self.compressor.compress(chunk.encode('utf-8', 'surrogatepass'))).decode()
+            if len(compressed) < len(chunk):  # short chunks are not worth it
+                record['zstd'] = compressed
+                if self.dictionary_id is not None:
+                    record['dict'] = self.dictionary_id
+        if 'zstd' not in record:
+            record['text'] = chunk
+        return (json.dumps(record) + '\n').encode()
+
+    def _chunk_text(self, line: bytes) -> str:
+        record = json.loads(line)
+        if 'text' in record:
+            return record['text']
+        if zstandard is None:
+            raise RuntimeError(f'zstandard is needed to read the compressed chunks in {self.directory}')
+        decompressor = zstandard.ZstdDecompressor(dict_data=self.dictionaries.get(record.get('dict')))
+        return decompressor.decompress(base64.b64decode(record['zstd'])).decode('utf-8', 'surrogatepass')
+
+    def verify(self, user: str, token: str, data: dict):
+        ''' Queue a verify record with `data`, which `get` merges into the completion's data. Raises `InvalidToken`
+            if `user` has no completion with this token, and `AlreadyVerified` if it was verified before. '''
+
+        key, ukey = token_key(token), user_key(user)
+        line = (json.dumps({'user': user, 'token': token, 'verify': data}) + '\n').encode()
+        with self.lock:
+            if key in self.pending:
+                owner = self.pending[key][1]
+            else:
+                owner = self.index[key][3] if key in self.index else None
+            if not token or owner != ukey:
+                raise InvalidToken(token)
+            if key in self.verified or key in self.pending_verified:
+                raise AlreadyVerified(token)
+            self.pending_verified[key] = line
+        self._enqueue((VERIFY, key, ukey, line, ()))
+
+    def _enqueue(self, item):
+        if self.read_only:
+            raise ValueError(f'{self.directory} was opened read-only')
+        if self.closed:  # the writer has stopped, so write it ourselves
+            self._flush([item])
+        else:
+            self.queue.put(item)
+
+    def _write_behind(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # None is queued by `close`
+            items = [item for item in batch if item is not None]
+            if len(items) > 0:
+                self._flush(items)
+            if len(items) < len(batch):
+                return
+
+    def _flush(self, items):
+        ''' Write a batch, retrying if the write fails. If all attempts fail, the records are dropped. '''
+        for attempt in range(1, WRITE_ATTEMPTS + 1):
+            try:
+                self._write(items)
+                return
+            except Exception:
+                logger.exception(f'Failed to write {len(items)} records to {self.directory} '
+                                 f'(attempt {attempt} of {WRITE_ATTEMPTS})')
+                with self.lock:
+                    self.metrics['failed_writes'] += 1
+            if attempt < WRITE_ATTEMPTS:
+                time.sleep(WRITE_RETRY_SECONDS * 2 ** (attempt - 1))
+        self._fail(items)
+
+    def _fail(self, items):
+        ''' Drop the records of a batch that could not be written from the queued records, so they are not read or
+            counted as stored, and a verify token whose verify record was lost can be verified again. '''
+        logger.error(f'Lost {len(items)} records that could not be written to {self.directory}')
+        with self.lock:
+            for kind, key, ukey, line, chunks in items:
+                self._release(chunks)
+                if key is None:
+                    continue
+                if kind == VERIFY:
+                    self.pending_verified.pop(key, None)
+                elif self.pending.get(key, (None,))[0] is line:  # unless there is a newer record
+                    del self.pending[key]
+                    if key not in self.index:
+                        self.counts[ukey] -= 1
+            self.metrics['failed_records'] += len(items)
+
+    def _release(self, chunks):
+        ''' Forget the lines of queued chunks that no queued record refers to anymore. Called holding `lock`. '''
+        for key, _ in chunks:
+            pending = self.pending_chunks[key]
+            pending[1] -= 1
+            if pending[1] == 0:
+                del self.pending_chunks[key]
+
+    def _write(self, items):
+        ''' Append a batch of (kind, key, user key, line, chunks) records, with one write per segment. The chunks
+            of a record that are not written yet are written right before it, in the same segment. Records without
+            a key (i.e. of filtered requests) are not indexed. If writing fails, the files are truncated to before
+            the batch, and nothing of it is indexed. '''
+
+        t0 = time.perf_counter()
+        with self.lock:
+            stored = {chunk for item in items for chunk, _ in item[4] if chunk in self.chunks}
+        entries, lines = [], []
+        with self.write_lock:
+            start = (self.segment, self.offset, self.index_file.tell())
+            try:
+                offset = self.offset
+                for kind, key, ukey, line, chunks in items:
+                    records = [(CHUNK, chunk, NO_USER, chunk_line) for chunk, chunk_line in chunks if chunk not in stored]
+                    records.append((kind, key, ukey, line))
+                    stored.update(chunk for chunk, _ in chunks)
+                    size = sum(len(record[3]) for record in records)
+                    if offset > 0 and offset + size > self.segment_max_bytes:
+                        self._write_lines(lines)
+                        lines, offset = [], 0
+                        self._rotate()
+                    for kind, key, ukey, line in records:
+                        if key is not None:
+                            entries.append((kind, key, ukey, self.segment, offset, len(line)))
+                        lines.append(line)
+                        offset += len(line)
+                self._write_lines(lines)
+
+                # the index can be rebuilt from the segments, so it is not synced
+                if len(entries) > 0:
+                    self.index_file.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in entries))
+                    self.index_file.flush()
+            except BaseException:
+                self._rollback(*start)
+                raise
+            self.offset = self.segment_file.tell()
+
+        with self.lock:
+            for entry in entries:
+                self._index(*entry, count=False)  # counted when appended
+            for kind, key, ukey, line, chunks in items:
+                self._release(chunks)
+                if key is None:
+                    continue
+                if kind == VERIFY:
+                    del self.pending_verified[key]
+                elif self.pending.get(key, (None,))[0] is line:  # unless there is a newer record queued
+                    del self.pending[key]
+
+            flush_ms = (time.perf_counter() - t0) * 1000
+            self.metrics['flushes'] += 1
+            self.metrics['records'] += len(items)
+            self.metrics['last_batch_size'] = len(items)
+            self.metrics['flush_ms_total'] += flush_ms
+            self.metrics['flush_ms_max'] = max(self.metrics['flush_ms_max'], flush_ms)
+
+    def _write_lines(self, lines):
+        if len(lines) == 0:
+            return
+        self.segment_file.write(b''.join(lines))
+        self.segment_file.flush()
+        if self.fsync:
+            os.fsync(self.segment_file.fileno())
+
+    def close(self):
+        ''' Write the queued records and stop the writer. Called at exit. '''
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.writer.join()
+
+        # records queued while closing
+        items = []
+        while not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        if len(items) > 0:
+            self._flush(items)
+
+    def stats(self) -> dict:
+        with self.lock:
+            flushes = self.metrics['flushes']
+            return {
+                'queue_depth': self.queue.qsize(),
+                'pending': len(self.pending) + len(self.pending_verified) + len(self.pending_chunks),
+                'chunks': len(self.chunks),
+                **self.metrics,
+                'flush_ms_mean': self.metrics['flush_ms_total'] / flushes if flushes > 0 else 0.0,
+            }
+
+    def _rotate(self):
+        self.segment_file.close()
+        self.segment += 1
+        self.segment_file = open(self.segment_path(self.segment), 'ab')
+        self.offset = 0
+
+    def _rollback(self, segment: int, offset: int, index_size: int):
+        ''' Truncate the segments and index to the given sizes, from before a failed write, so that a partially
+            written batch does not shift the offsets of the records written after it. '''
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        for f in (self.segment_file, self.index_file):
+            try:
+                f.close()  # if flushing fails again, what is left in the buffer is dropped
+            except OSError:
+                pass
+        try:
+            for rotated in range(self.segment, segment, -1):
+                os.remove(self.segment_path(rotated))
+            os.truncate(self.segment_path(segment), offset)
+            os.truncate(index_path, index_size)
+        finally:
+            self.segment = segment
+            self.segment_file = open(self.segment_path(segment), 'ab')
+            self.offset = self.segment_file.tell()
+            self.index_file = open(index_path, 'ab')
+
+    def get(self, token: str) -> Optional[dict]:
+        ''' The latest completion record of a verify token, as {'user', 'token', 'data'}, including queued records.
+            If the completion was verified, the verify payload is merged into its data. '''
+
+        key = token_key(token)
+        with self.lock:
+            pending, location = self.pending.get(key), self.index.get(key)
+            verify_line, verify_location = self.pending_verified.get(key), self.verified.get(key)
+        if pending is not None:
+            record = self.reassemble(json.loads(pending[0]))
+        elif location is not None:
+            record = self.reassemble(json.loads(self.read(location[:3])))
+        else:
+            return None
+
+        if verify_line is None and verify_location is not None:
+            verify_line = self.read(verify_location)
+        if verify_line is not None:
+            record['data'].update(json.loads(verify_line)['verify'])
+        return record
+
+    def __contains__(self, token: str) -> bool:
+        ''' Whether there is a completion record of a verify token, without reading it '''
+        key = token_key(token)
+        with self.lock:
+            return key in self.index or key in self.pending
+
+    def reassemble(self, record: dict) -> dict:
+        ''' Replace the chunk keys of a completion record by the contexts they make up '''
+        for field, keys in record.pop('chunks', {}).items():
+            record['data'][field] = ''.join(self.chunk(bytes.fromhex(key)) for key in keys)
+        return record
+
+    def chunk(self, key: bytes) -> str:
+        with self.lock:
+            pending, location = self.pending_chunks.get(key), self.chunks.get(key)
+        return self._chunk_text(pending[0] if pending is not None else self.read(location))
+
+    def read(self, location: Tuple[int, int, int]) -> bytes:
+        segment, offset, length = location
+        with open(self.segment_path(segment), 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def count(self, user: str) -> int:
+        ''' Number of completions with a verify token stored for a user '''
+        with self.lock:
+            return self.counts[user_key(user)]
+
+    def records(self) -> Iterator[dict]:
+        ''' All completion and verify records, in the order they were appended, with the contexts of completions
+            reassembled. Verify records have a 'verify' payload instead of 'data'. '''
+        for segment in self.segments():
+            for offset, line in scan(self.segment_path(segment)):
+                record = json.loads(line)
+                if 'chunk' in record:
+                    # a read-only store can read on past what it indexed
+                    with self.lock:
+                        self.chunks.setdefault(bytes.fromhex(record['chunk']), (segment, offset, len(line)))
+                else:
+                    yield self.reassemble(record)
+
+    def train_dictionary(self, size: int = DICTIONARY_SIZE, max_samples: int = DICTIONARY_SAMPLES) -> int:
+        ''' Train a zstd dictionary on the latest chunks, which compresses the chunks appended from now on.
+            Dictionaries are kept, as the chunks compressed with them refer to them by id. Returns the new id. '''
+
+        samples = deque(maxlen=max_samples)
+        for segment in self.segments():
+            for _, line in scan(self.segment_path(segment)):
+                if line.startswith(b'{"chunk"'):
+                    samples.append(self._chunk_text(line).encode('utf-8', 'surrogatepass'))
+        dictionary = zstandard.train_dictionary(size, list(samples))
+
+        with self.enqueue_lock:
+            dictionary_id = max(self.dictionaries, default=-1) + 1
+            with open(os.path.join(self.directory, DICTIONARY_FILE.format(dictionary_id)), 'wb') as f:
+                f.write(dictionary.as_bytes())
+            self.dictionaries[dictionary_id], self.dictionary_id = dictionary, dictionary_id
+            self.compressor = self.create_compressor()
+        return dictionary_id
+
+    def usage(self) -> dict:
+        ''' Bytes on disk, per kind of record, and the size of the contexts the completions refer to '''
+
+        usage = Counter()
+        chunk_chars = {}
+        for segment in self.segments():
+            for _, line in scan(self.segment_path(segment)):
+                record = json.loads(line)
+                if 'chunk' in record:
+                    usage['chunk_bytes'] += len(line)
+                    chunk_chars[record['chunk']] = len(self._chunk_text(line))
+                else:
+                    kind = 'verify' if 'verify' in record else 'completion'
+                    usage[f'{kind}_bytes'] += len(line)
+                    usage[f'{kind}s'] += 1
+                    for keys in record.get('chunks', {}).values():
+                        usage['context_chars'] += sum(chunk_chars.get(key, 0) for key in keys)
+        usage['chunks'] = len(chunk_chars)
+        usage['chunk_chars'] = sum(chunk_chars.values())
+        return dict(usage)
+
+
+def truncate_partial_line(file_path: str):
+    ''' Remove whatever follows the last newline, i.e. a record that was only partially written '''
+
+    with open(file_path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(0, end - 65536)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            print(f'Truncating {size - end} bytes of a partially written record from {file_path}')
+            f.truncate(end)
+
+
+def scan(file_path: str, start: int = 0) -> Iterator[Tuple[int, bytes]]:
+    ''' (offset, line) of every complete line in a segment from `start` on '''
+
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        for line in f:
+            if not line.endswith(b'\n'):
+                break  # still being written, or a partial record that recovery truncates
+            yield offset, line
+            offset += len(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Report the disk usage of a log store, or train its zstd dictionary. '
+                                                 'Run it while the server is stopped.')
+    parser.add_argument('directory')
+    parser.add_argument('--train-dictionary', action='store_true')
+    parser.add_argument('--dictionary-size', type=int, default=DICTIONARY_SIZE)
+    args = parser.parse_args()
+
+    store = LogStore(args.directory)
+    if args.train_dictionary:
+        if zstandard is None:
+            raise SystemExit('Training a dictionary needs zstandard')
+        print(f'Trained dictionary {store.train_dictionary(args.dictionary_size)}')
+    print(json.dumps(store.usage(), indent=2))
+    store.close()
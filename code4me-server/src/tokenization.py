@@ -0,0 +1,101 @@
+from typing import List, Tuple
+from transformers import AddedToken, GPT2Tokenizer, GPT2TokenizerFast
+
+''' Bounded tokenisation of the context around the cursor. Instead of tokenising a whole file and
+    keeping the last (or first) n tokens, we tokenise a window that grows away from the cursor until
+    it holds n tokens, so tokenisation cost depends on the model's budget rather than the file size.
+
+    Windows are cut right before a `boundary` (a line break by default). For the byte-level BPE
+    tokenizers our models use, no token crosses a line break that follows a non-whitespace
+    character, and no token crosses an added special token like CodeGPT's `<EOL>`. So the tokens
+    of the window are the last (or first) tokens of the whole text, as tokenised by the same tokenizer.
+    tests/test_tokenization.py checks this for each model's tokenizer, against the ids of the slow
+    tokenizers the models used before. '''
+
+CHARS_PER_TOKEN = 4  # initial guess for the window size, it grows as needed
+CODEGPT_SPECIAL_TOKENS = {
+    'sep_token': '<EOL>', 'bos_token': '<s>', 'eos_token': '</s>', 'pad_token': '<pad>', 'unk_token': '<|UNKNOWN|>',
+}
+
+
+def codegpt_tokenizer(checkpoint_path: str, fast: bool = True):
+    ''' CodeGPT's tokenizer. The slow GPT2Tokenizer strips the whitespace around special tokens that are given as
+        str, so the indentation after an `<EOL>` is dropped. CodeGPT has always been prompted like that, so the
+        fast tokenizer gets them as AddedTokens that strip the whitespace around them too. '''
+
+    if not fast:
+        return GPT2Tokenizer.from_pretrained(checkpoint_path, do_lower_case=False, **CODEGPT_SPECIAL_TOKENS)
+    special_tokens = {name: AddedToken(token, lstrip=True, rstrip=True) for name, token in CODEGPT_SPECIAL_TOKENS.items()}
+    return GPT2TokenizerFast.from_pretrained(checkpoint_path, do_lower_case=False, **special_tokens)
+
+
+def token_ids(tokenizer, text: str) -> List[int]:
+    return tokenizer(text, add_special_tokens=False)['input_ids']
+
+
+def is_boundary(text: str, i: int, boundary: str) -> bool:
+    # a whitespace boundary merges with whitespace before it, so that would not be a clean cut
+    return not boundary.isspace() or (i > 0 and not text[i - 1].isspace())
+
+
+def tail_token_ids(tokenizer, text: str, budget: int, boundary: str = '\n') -> List[int]:
+    ''' Equivalent to `token_ids(tokenizer, text)[-budget:]` '''
+
+    if budget <= 0:  # the window would never grow
+        return []
+    n_chars = budget * CHARS_PER_TOKEN
+    while n_chars < len(text):
+        start = text.find(boundary, len(text) - n_chars)
+        while start != -1 and not is_boundary(text, start, boundary):
+            start = text.find(boundary, start + 1)
+
+        if start != -1:
+            ids = token_ids(tokenizer, text[start:])
+            if len(ids) >= budget:
+                return ids[len(ids) - budget:]
+        n_chars *= 2
+
+    return token_ids(tokenizer, text)[-budget:]
+
+
+def head_token_ids(tokenizer, text: str, budget: int, boundary: str = '\n') -> List[int]:
+    ''' Equivalent to `token_ids(tokenizer, text)[:budget]` '''
+
+    if budget <= 0:
+        return []
+    n_chars = budget * CHARS_PER_TOKEN
+    while n_chars < len(text):
+        end = text.find(boundary, n_chars)
+        while end != -1 and not is_boundary(text, end, boundary):
+            end = text.find(boundary, end + 1)
+
+        if end != -1:
+            ids = token_ids(tokenizer, text[:end])
+            if len(ids) >= budget:
+                return ids[:budget]
+        n_chars *= 2
+
+    return token_ids(tokenizer, text)[:budget]
+
+
+def joint_token_ids(tokenizer, prefix: str, suffix: str, max_length: int = 512,
+                    max_suffix_tokens: int = 128) -> Tuple[List[int], List[int]]:
+    ''' `<s> prefix </s> suffix </s> <pad>...` as (input_ids, attention_mask), `max_length` long. The suffix gets
+        up to `max_suffix_tokens` tokens (including its `</s>`), the prefix keeps its last tokens in the rest of
+        the budget, and the suffix fills what the prefix leaves unused. Prefix and suffix are each tokenised once,
+        and the tokenizer is not reconfigured, so this is safe to call from concurrent requests. '''
+
+    bos, eos, pad = tokenizer.cls_token_id, tokenizer.sep_token_id, tokenizer.pad_token_id
+
+    # the suffix never gets more than the budget minus the smallest prefix, `<s> </s>`
+    suffix_ids = head_token_ids(tokenizer, suffix, max_length - 3)
+    n_suffix = min(len(suffix_ids), max_suffix_tokens - 1) + 1
+    prefix_ids = tail_token_ids(tokenizer, prefix, max_length - n_suffix - 2)
+    n_prefix = len(prefix_ids) + 2
+
+    suffix_ids = suffix_ids[:max_length - n_prefix - 1] + [eos]
+    n_pad = max_length - n_prefix - len(suffix_ids)
+
+    input_ids = [bos] + prefix_ids + [eos] + suffix_ids + [pad] * n_pad
+    attention_mask = [1] * (n_prefix + len(suffix_ids)) + [0] * n_pad
+    return input_ids, attention_mask
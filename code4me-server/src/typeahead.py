@@ -0,0 +1,45 @@
+import threading
+
+from collections import OrderedDict
+from typing import Dict, Optional
+
+''' Typed-ahead reuse of completions. When a user keeps typing the completion we just served,
+    the new prefix is the old prefix plus the start of that completion, so we can answer with
+    the rest of the old completion without running the model. '''
+
+MAX_USERS = 1000
+
+
+class TypeaheadCache:
+
+    def __init__(self, max_users: int = MAX_USERS):
+        self.max_users = max_users
+        self.last = OrderedDict()  # user -> (prefix, suffix, {model_name: completion}), in LRU order
+        self.lock = threading.Lock()
+
+    def lookup(self, user: str, model_name: str, prefix: str, suffix: str) -> Optional[str]:
+        ''' Return the remaining part of the user's last completion if they typed along with it '''
+
+        with self.lock:
+            if user not in self.last:
+                return None
+            last_prefix, last_suffix, completions = self.last[user]
+
+        completion = completions.get(model_name)
+        if not completion or suffix != last_suffix or not prefix.startswith(last_prefix):
+            return None
+
+        typed = prefix[len(last_prefix):]
+        if len(typed) >= len(completion) or not completion.startswith(typed):
+            return None
+        return completion[len(typed):]
+
+    def remember(self, user: str, prefix: str, suffix: str, completions: Dict[str, str]):
+        with self.lock:
+            self.last[user] = (prefix, suffix, dict(completions))
+            self.last.move_to_end(user)
+            if len(self.last) > self.max_users:
+                self.last.popitem(last=False)
+
+
+typeahead_cache = TypeaheadCache()
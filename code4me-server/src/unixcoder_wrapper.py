@@ -3,6 +3,10 @@ import os
 
 import torch
 from unixcoder import UniXcoder
+from decode_engine import DecodeAdapter, DecodeEngine, to_past
+from completion_cache import completion_cache, cache_key
+from tokenization import tail_token_ids
+from cancellation import CancellationToken
 
 device_name = os.environ.get("UNIXCODER_DEVICE", "cuda:0" if torch.cuda.is_available() else "cpu")
 device = torch.device(device_name)
@@ -17,9 +21,50 @@ stop_tokens = [
 ]
 
 
-def generate(left_context: str, right_context: str) -> List[str]:
-    tokens_ids = model.tokenize([left_context], max_length=936, mode="<decoder-only>")
+class UniXcoderAdapter(DecodeAdapter):
+
+    # RoBERTa position ids start after the padding index
+    position_offset = model.config.pad_token_id + 1
+
+    def prefill(self, input_ids, past=None):
+        past_length = past[0][0].size(2) if past is not None else 0
+        length = past_length + input_ids.size(-1)
+        outputs = model.model(input_ids, attention_mask=model.bias[:, past_length:length, :length], past_key_values=past)
+        return to_past(outputs.past_key_values), model.lm_head(outputs.last_hidden_state[:, -1, :])
+
+    def step(self, input_ids, past, attention_mask, position_ids):
+        outputs = model.model(input_ids, attention_mask=attention_mask.unsqueeze(1),
+                              past_key_values=past, position_ids=position_ids)
+        return model.lm_head(outputs.last_hidden_state[:, -1, :]), to_past(outputs.past_key_values)
+
+
+# set UNIXCODER_MAX_BATCH_SIZE=0 to fall back to decoding each request on its own
+max_batch_size = int(os.environ.get("UNIXCODER_MAX_BATCH_SIZE", 8))
+engine = DecodeEngine("unixcoder", UniXcoderAdapter(), device, max_batch_size) if max_batch_size > 0 else None
+
+
+def generate(left_context: str, right_context: str, session: str = None,
+             cancel_token: CancellationToken = None) -> List[str]:
+    # same as model.tokenize([left_context], max_length=936, mode="<decoder-only>"), but only tokenizes
+    # as far back from the cursor as needed to fill the window
+    tokenizer = model.tokenizer
+    prompt_ids = tokenizer.convert_tokens_to_ids([tokenizer.cls_token, "<decoder-only>", tokenizer.sep_token])
+    tokens_ids = [prompt_ids + tail_token_ids(tokenizer, left_context, 936 - 3)]
+    return completion_cache.get_or_compute(cache_key("UniXCoder", tokens_ids[0]), lambda: predict_tokens(tokens_ids, session, cancel_token))
+
+
+def predict_tokens(tokens_ids: List[List[int]], session: str = None, cancel_token: CancellationToken = None) -> List[str]:
+    if engine is not None:
+        # greedy decoding, which is what UniXcoder.generate does with beam_size = 1
+        prediction_ids = engine.generate(tokens_ids[0], 128, stop_ids=stop_tokens, eos_ids=[model.config.eos_token_id],
+                                         session=session, cancel_token=cancel_token)
+        if 0 in prediction_ids:
+            prediction_ids = prediction_ids[:prediction_ids.index(0)]
+        prediction = model.tokenizer.decode(prediction_ids, clean_up_tokenization_spaces=False)
+        return [prediction.strip().split("\n")[0]]
+
     source_ids = torch.tensor(tokens_ids).to(device)
-    prediction_ids = model.generate(source_ids, decoder_only=True, beam_size=1, max_length=128, stop_tokens=stop_tokens)
+    prediction_ids = model.generate(source_ids, decoder_only=True, beam_size=1, max_length=128, stop_tokens=stop_tokens,
+                                    cancel_token=cancel_token)
     predictions = model.decode(prediction_ids)
     return [prediction.strip().split("\n")[0] for prediction in predictions[0]]
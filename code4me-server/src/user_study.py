@@ -2,8 +2,9 @@ import os, enum, random, json, pickle
 
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Tuple, Callable
+from typing import Tuple, Callable, Optional
 from query_filter import Filter, filters
+from store import LogStore
 
 SESSION_TIMEOUT = 1800
 MAX_CACHE_SIZE = 30
@@ -12,6 +13,9 @@ STUDY_VERSION = '0.0.1'
 USER_STUDY_DIR = 'data_aral'
 os.makedirs(USER_STUDY_DIR, exist_ok=True)
 
+# completion requests, see `import_study_data.py` for moving the USER_STUDY_DIR/user_uuid/verify_token.json files into it
+study_store = LogStore(os.path.join(USER_STUDY_DIR, 'store'), chunked_fields=('prefix', 'suffix'))
+
 
 # Cache of user_uuid -> (last_access, filter_type)
 # which allows us to retrieve the Filter predict function via filters[filter_type]
@@ -32,6 +36,14 @@ def get_request_filter(user_uuid: str, time: datetime) -> Callable[[dict], bool]
 
     return filter_type, last_access
 
+def peek_request_filter(user_uuid: str, time: datetime) -> Optional[Filter]:
+    ''' The filter `get_request_filter` would assign, without touching the session. 
+        None if the user would start a new session, i.e. get a random filter '''
+
+    if user_uuid in cache and (time - cache[user_uuid][0]).seconds < SESSION_TIMEOUT:
+        return cache[user_uuid][1]
+    return None
+
 def prune_cache(time: datetime):
     ''' Prune cache of users with expired sessions, or update MAX_CACHE_SIZE to grow 
         proportionally. I.e. minimise memory while ensuring all users are kept track of '''
@@ -72,21 +84,13 @@ def filter_request(user_uuid: str, completion_request: dict) -> Tuple[float, Fil
 
 
 def store_completion_request(user_uuid: str, verify_token: str, completion_request: dict):
-    ''' Store the completion request in USER_STUDY_DIR/user_uuid/verify_token.json '''
-
-    user_dir = os.path.join(USER_STUDY_DIR, user_uuid)
-    json_file = f'{verify_token}.json'
-    os.makedirs(user_dir, exist_ok=True)
-
-    with open(os.path.join(user_dir, json_file), 'w') as f:
-        f.write(json.dumps(completion_request))
+    ''' Store the completion request in the study's log store, under its verify token '''
 
-def should_prompt_survey(user_uuid: str):
-    ''' Return whether to prompt the user with survey. I re-specify it here, 
-        as it depends on `USER_STUDY_DIR` '''
+    study_store.append(user_uuid, verify_token, completion_request)
 
-    user_dir = os.path.join(USER_STUDY_DIR, user_uuid)
-    if not os.path.exists(user_dir): return False
+def should_prompt_survey(user_uuid: str, store: LogStore = study_store):
+    ''' Return whether to prompt the user with survey, based on their number of completions in `store`.
+        The store keeps a counter per user, so this does not depend on the size of the user's history. '''
 
-    n_suggestions = len(os.listdir(user_dir))
+    n_suggestions = store.count(user_uuid)
     return n_suggestions >= 100 and n_suggestions % 50 == 0
@@ -0,0 +1,74 @@
+import os, queue, threading
+
+from concurrent.futures import Future
+from typing import Dict
+from model import Model
+from cancellation import Cancelled
+
+import codegpt, unixcoder_wrapper
+
+''' Long-lived inference workers, one per `Model`. Each worker owns a bounded queue and a fixed
+    number of threads, so requests to the same model are serialised instead of every Flask thread
+    calling into torch at once. Models that decode through a `DecodeEngine` get as many threads as
+    the engine batches, since the engine thread already serialises access to the model itself. '''
+
+MAX_QUEUE_SIZE = int(os.getenv('WORKER_MAX_QUEUE_SIZE', 64))
+
+
+class WorkerBusy(Exception):
+    ''' Raised when a worker's queue is full '''
+
+
+class ModelWorker:
+
+    def __init__(self, model: Model, n_threads: int = 1, max_queue_size: int = MAX_QUEUE_SIZE):
+        self.model = model
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.threads = [
+            threading.Thread(target=self._run, name=f'{model.name}-worker-{i}', daemon=True)
+            for i in range(n_threads)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, *args, **kwargs) -> Future:
+        ''' Queue a call to the model's generate function. Raises `WorkerBusy` if the queue is full. '''
+        future = Future()
+        try:
+            self.queue.put_nowait((future, args, kwargs))
+        except queue.Full:
+            raise WorkerBusy(f'{self.model.name} worker queue is full ({self.queue.maxsize})')
+        return future
+
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def _run(self):
+        generate = self.model.value[1]
+        while True:
+            future, args, kwargs = self.queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            cancel_token = kwargs.get('cancel_token')
+            if cancel_token is not None and cancel_token.cancelled:
+                future.set_exception(Cancelled())
+                continue
+            try:
+                future.set_result(generate(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+def n_threads(model: Model) -> int:
+    engine = {
+        Model.CodeGPT: codegpt.engine,
+        Model.UniXCoder: unixcoder_wrapper.engine,
+    }.get(model)
+    return engine.max_batch_size if engine is not None else 1
+
+
+workers = {model: ModelWorker(model, n_threads(model)) for model in Model}
+
+
+def queue_depths() -> Dict[str, int]:
+    return {model.name: worker.queue_depth() for model, worker in workers.items()}
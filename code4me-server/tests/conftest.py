@@ -0,0 +1,4 @@
+import os, sys
+
+# the server's modules are imported by name, as they are when running from src/
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
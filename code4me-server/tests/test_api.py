@@ -0,0 +1,137 @@
+import sys, enum, json, types, pytest
+
+pytest.importorskip('flask')
+pytest.importorskip('flask_limiter')
+
+from flask import Flask
+
+try:
+    import query_filter
+except OSError:  # the filter's tokenizer is not available
+    query_filter = None
+
+''' Calls the api's endpoints through Flask's test client. The model modules, which load their checkpoints when
+    imported, are replaced by modules whose generate functions return a fixed prediction, and so is the request
+    filter module if its tokenizer cannot be loaded. The api's stores are created in a temporary directory. '''
+
+MODEL_MODULES = {'incoder': 'generate', 'unixcoder_wrapper': 'generate', 'codegpt': 'codegpt_predict'}
+API_MODULES = ['api', 'workers', 'model', 'user_study']
+
+
+def fake_model_module(name: str, generate_name: str) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.engine = None
+    setattr(module, generate_name, lambda left, right, session=None, cancel_token=None: [f' {name}'])
+    return module
+
+
+def fake_filter_module() -> types.ModuleType:
+    module = types.ModuleType('query_filter')
+    module.Filter = enum.Enum('Filter', {'NO_FILTER': 'no_filter', 'FEATURE': 'feature'})
+    module.filters = {}
+    return module
+
+
+@pytest.fixture
+def api(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name, generate_name in MODEL_MODULES.items():
+        monkeypatch.setitem(sys.modules, name, fake_model_module(name, generate_name))
+    monkeypatch.setitem(sys.modules, 'query_filter', query_filter or fake_filter_module())
+    for name in API_MODULES:
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    import api, user_study
+
+    # every request is predicted for
+    monkeypatch.setattr(user_study, 'filters', {user_study.Filter.NO_FILTER: lambda request_json: False})
+    yield api
+    for name in API_MODULES:
+        sys.modules.pop(name, None)
+
+
+@pytest.fixture
+def client(api):
+    from limiter import limiter
+    app = Flask(__name__)
+    limiter.init_app(app)
+    app.register_blueprint(api.v1, url_prefix='/api/v1')
+    app.register_blueprint(api.v2, url_prefix='/api/v2')
+    return app.test_client()
+
+
+AUTH = {'Authorization': 'Bearer user'}
+COMPLETION_REQUEST = {'prefix': 'def f(x):\n    return ', 'suffix': '\n', 'trigger': 'auto', 'language': 'python'}
+
+
+def test_autocomplete_v2(api, client):
+    resp = client.post('/api/v2/prediction/autocomplete', json=COMPLETION_REQUEST, headers=AUTH)
+    assert resp.status_code == 200
+    body = resp.get_json()
+    assert body['predictions'] == {model.name: f' {module}' for model, module in zip(api.Model, MODEL_MODULES)}
+
+    data = api.study_store.get(body['verifyToken'])['data']
+    assert data['predictions'] == body['predictions'] and data['deadline_ms'] == 0
+    assert data['prefix'] == COMPLETION_REQUEST['prefix']
+
+
+def test_autocomplete_stream_v2(api, client):
+    resp = client.post('/api/v2/prediction/autocomplete/stream', json=COMPLETION_REQUEST, headers=AUTH)
+    assert resp.status_code == 200
+    events = resp.get_data(as_text=True)
+    assert events.startswith('event: start') and 'event: end' in events
+
+    # stored once the stream is closed
+    verify_token = events.split('"verifyToken": "')[1].split('"')[0]
+    data = api.study_store.get(verify_token)['data']
+    assert data['streamed'] and data['deadline_ms'] == 0
+    assert set(data['predictions']) == {model.name for model in api.Model}
+
+
+V1_REQUEST = {'leftContext': 'def f(x):\n    return ', 'rightContext': '\n', 'triggerPoint': 'return', 'language': 'Python',
+              'ide': 'vsc', 'keybind': False, 'pluginVersion': '1.0', 'storeContext': True}
+
+
+def test_autocomplete_v1(api, client):
+    resp = client.post('/api/v1/prediction/autocomplete', json=V1_REQUEST, headers=AUTH)
+    assert resp.status_code == 200
+    body = json.loads(resp.get_data())
+    assert sorted(body['predictions']) == sorted(f' {module}' for module in MODEL_MODULES)
+
+    data = api.v1_store.get(body['verifyToken'])['data']
+    assert data['leftContext'] == V1_REQUEST['leftContext'] and data['timedOut'] == []
+
+
+def test_autocomplete_v1_busy_worker(api, client, monkeypatch):
+    from workers import WorkerBusy
+
+    def busy(*args, **kwargs):
+        raise WorkerBusy('busy')
+    monkeypatch.setattr(api.workers[api.Model.InCoder], 'submit', busy)
+
+    resp = client.post('/api/v1/prediction/autocomplete', json=V1_REQUEST, headers=AUTH)
+    assert resp.status_code == 200
+    body = json.loads(resp.get_data())
+    assert sorted(body['predictions']) == [' codegpt', ' unixcoder_wrapper']
+
+    data = api.v1_store.get(body['verifyToken'])['data']
+    assert data['timedOut'] == ['InCoder'] and 'InCoder' not in data['modelPredictions']
+
+
+def test_metrics(api, client):
+    client.post('/api/v2/prediction/autocomplete', json=COMPLETION_REQUEST, headers=AUTH)
+    api.study_store.close()  # writes the queued record
+
+    metrics = json.loads(json.dumps(api.metrics()))  # as it is logged
+    assert set(metrics['queue_depths']) == {model.name for model in api.Model}
+    assert metrics['study_store']['records'] == 1 and metrics['study_store']['queue_depth'] == 0
+    assert metrics['study_store']['flush_ms_max'] >= 0 and metrics['v1_store']['flushes'] == 0
+
+
+def test_completion_cache_metrics(api):
+    from completion_cache import completion_cache, cache_key
+    key = cache_key('test', [1, 2, 3])
+    completion_cache.get_or_compute(key, lambda: [' completion'])
+    completion_cache.get_or_compute(key, lambda: [' completion'])
+
+    metrics = api.metrics()['completion_cache']
+    assert metrics['hits'] >= 1 and metrics['misses'] >= 1 and 0.0 < metrics['hit_rate'] < 1.0
@@ -0,0 +1,172 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from beam import Beam
+
+''' Compares the tensorized `beam.Beam` to the per-sample `Beam` classes that came with CodeGPT and UniXcoder,
+    on seeded random log-probs. '''
+
+DEVICE = torch.device('cpu')
+VOCAB_SIZE = 40
+STEPS = 12
+
+
+class CodeGPTBeam(object):
+    ''' The `Beam` of codegpt.py before it was replaced by `beam.Beam`, with a list of eos ids '''
+
+    def __init__(self, size, sos, eos):
+        self.size = size
+        self.scores = torch.FloatTensor(size).zero_().to(DEVICE)
+        self.prevKs = []
+        self.nextYs = [torch.LongTensor(size).fill_(0).to(DEVICE)]
+        self.nextYs[0][:] = sos
+        self._eos = eos
+        self.eosTop = False
+        self.finished = []
+
+    def advance(self, wordLk):
+        numWords = wordLk.size(1)
+        if len(self.prevKs) > 0:
+            beamLk = wordLk + self.scores.unsqueeze(1).expand_as(wordLk)
+            for i in range(self.nextYs[-1].size(0)):
+                if self.nextYs[-1][i] in self._eos:
+                    beamLk[i] = -1e20
+        else:
+            beamLk = wordLk[0]
+        flatBeamLk = beamLk.view(-1)
+        bestScores, bestScoresId = flatBeamLk.topk(self.size, 0, True, True)
+        self.scores = bestScores
+        prevK = torch.div(bestScoresId, numWords, rounding_mode='trunc')
+        self.prevKs.append(prevK)
+        self.nextYs.append((bestScoresId - prevK * numWords))
+        for i in range(self.nextYs[-1].size(0)):
+            if self.nextYs[-1][i] in self._eos:
+                s = self.scores[i]
+                self.finished.append((s, len(self.nextYs) - 1, i))
+        if self.nextYs[-1][0] in self._eos:
+            self.eosTop = True
+
+    def done(self):
+        return self.eosTop and len(self.finished) >= self.size
+
+    def getFinal(self):
+        if len(self.finished) == 0:
+            self.finished.append((self.scores[0], len(self.nextYs) - 1, 0))
+        self.finished.sort(key=lambda a: -a[0])
+        if len(self.finished) != self.size:
+            unfinished = []
+            for i in range(self.nextYs[-1].size(0)):
+                if self.nextYs[-1][i] not in self._eos:
+                    s = self.scores[i]
+                    unfinished.append((s, len(self.nextYs) - 1, i))
+            unfinished.sort(key=lambda a: -a[0])
+            self.finished += unfinished[:self.size - len(self.finished)]
+        return self.finished[:self.size]
+
+    def getHyp(self, beam_res):
+        hyps = []
+        for _, timestep, k in beam_res:
+            hyp = []
+            for j in range(len(self.prevKs[:timestep]) - 1, -1, -1):
+                hyp.append(self.nextYs[j + 1][k])
+                k = self.prevKs[j][k]
+            hyps.append(hyp[::-1])
+        return hyps
+
+    def buildTargetTokens(self, preds):
+        sentence = []
+        for pred in preds:
+            tokens = []
+            for tok in pred:
+                tokens.append(tok)
+                if tok in self._eos:
+                    break
+            sentence.append(tokens)
+        return sentence
+
+
+class UniXcoderBeam(CodeGPTBeam):
+    ''' The `Beam` of unixcoder.py before it was replaced by `beam.Beam`, with a single eos id and sos 0 '''
+
+    def __init__(self, size, eos):
+        super().__init__(size, 0, [eos])
+
+    def buildTargetTokens(self, preds):
+        sentence = []
+        for pred in preds:
+            tokens = []
+            for tok in pred:
+                if tok == self._eos[0]:
+                    break
+                tokens.append(tok)
+            sentence.append(tokens)
+        return sentence
+
+
+def log_probs(generator, rows: int, eos, eos_boost: float):
+    ''' Random log-probs, with `eos_boost` added to the eos ids to make hypotheses finish early '''
+    logits = torch.randn(rows, VOCAB_SIZE, generator=generator)
+    logits[:, eos] += eos_boost
+    return logits.log_softmax(-1)
+
+
+def as_ints(hyps):
+    return [[int(tok) for tok in hyp] for hyp in hyps]
+
+
+def run(size: int, batch_size: int, eos, seed: int, variant: str, eos_boost):
+    generator = torch.Generator().manual_seed(seed)
+    if variant == 'codegpt':
+        # codegpt.py starts from the last prompt token, a 0-dim tensor
+        sos = torch.randint(VOCAB_SIZE, (), generator=generator)
+        old = [CodeGPTBeam(size, sos, eos) for _ in range(batch_size)]
+        new = Beam(size, sos, eos, DEVICE, batch_size=batch_size, include_eos=True)
+    else:
+        old = [UniXcoderBeam(size, eos[0]) for _ in range(batch_size)]
+        new = Beam(size, 0, eos[0], DEVICE, batch_size=batch_size)
+
+    for step in range(STEPS):
+        wordLk = log_probs(generator, batch_size * size, eos, eos_boost(step))
+        for b, beam in enumerate(old):
+            beam.advance(wordLk[b * size:(b + 1) * size].clone())
+        new.advance(wordLk.clone())
+
+        assert new.done() == all(beam.done() for beam in old)
+        for b, beam in enumerate(old):
+            assert new.nextYs[-1][b].tolist() == beam.nextYs[-1].tolist()
+            assert new.scores[b].tolist() == pytest.approx(beam.scores.tolist())
+
+    for b, beam in enumerate(old):
+        old_final, new_final = beam.getFinal(), new.getFinal(b)
+        assert [(t, k) for _, t, k in new_final] == [(t, k) for _, t, k in old_final]
+        assert [s for s, _, _ in new_final] == pytest.approx([float(s) for s, _, _ in old_final])
+
+        old_hyps, new_hyps = as_ints(beam.getHyp(old_final)), new.getHyp(new_final, b)
+        assert new_hyps == old_hyps
+        assert new.buildTargetTokens(new_hyps) == as_ints(beam.buildTargetTokens(old_hyps))
+
+
+@pytest.mark.parametrize('variant', ['codegpt', 'unixcoder'])
+@pytest.mark.parametrize('size', [1, 3, 5])
+@pytest.mark.parametrize('batch_size', [1, 4])
+@pytest.mark.parametrize('seed', range(3))
+def test_matches_previous_beam(variant, size, batch_size, seed):
+    run(size, batch_size, [2], seed, variant, lambda step: 0.0)
+
+
+@pytest.mark.parametrize('size', [1, 3, 5])
+@pytest.mark.parametrize('batch_size', [1, 3])
+@pytest.mark.parametrize('seed', range(3))
+def test_matches_previous_beam_with_multiple_eos(size, batch_size, seed):
+    run(size, batch_size, [2, 7, 11], seed, 'codegpt', lambda step: 0.0)
+
+
+@pytest.mark.parametrize('variant', ['codegpt', 'unixcoder'])
+@pytest.mark.parametrize('size', [1, 3, 5])
+@pytest.mark.parametrize('batch_size', [1, 4])
+@pytest.mark.parametrize('seed', range(3))
+def test_matches_previous_beam_with_early_eos(variant, size, batch_size, seed):
+    ''' Eos is likely in the first steps, so hypotheses finish (and the search is done) before the last step '''
+    eos = [2, 7] if variant == 'codegpt' else [2]
+    run(size, batch_size, eos, seed, variant, lambda step: 4.0 if step < 3 else 0.0)
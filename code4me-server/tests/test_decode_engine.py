@@ -0,0 +1,151 @@
+import random, threading, time, pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+from transformers import GPT2Config, GPT2LMHeadModel
+from decode_engine import DecodeAdapter, DecodeEngine, to_past
+from prefix_cache import prefix_cache
+
+''' Compares the continuous-batching decode engine to greedy decoding of each request on its own, without a kv
+    cache, on a tiny randomly initialised GPT2. Requests join the running batch while others decode, leave it at
+    their token budget or a stop token, and are left-padded to the batch's length (or the batch to theirs). '''
+
+VOCAB_SIZE = 64
+
+
+@pytest.fixture(scope='module')
+def model():
+    torch.manual_seed(0)
+    config = GPT2Config(vocab_size=VOCAB_SIZE, n_positions=256, n_embd=32, n_layer=2, n_head=4)
+    # in double precision, so that padding does not change which token is the most likely one
+    return GPT2LMHeadModel(config).eval().double()
+
+
+class GPT2Adapter(DecodeAdapter):
+    ''' As `codegpt.CodeGPTAdapter`, or predicting the first token from the prompt with `prefill_logits`. Calls
+        `on_step` with the number of steps so far before every step. '''
+
+    def __init__(self, model, prefill_logits: bool, on_step=None):
+        self.model = model
+        self.prefill_logits = prefill_logits
+        self.on_step = on_step
+        self.batch_sizes = []
+
+    def prefill(self, input_ids, past=None):
+        outputs = self.model(input_ids, past_key_values=past)
+        return to_past(outputs.past_key_values), outputs.logits[:, -1, :] if self.prefill_logits else None
+
+    def step(self, input_ids, past, attention_mask, position_ids):
+        if self.on_step is not None:
+            self.on_step(len(self.batch_sizes))
+        self.batch_sizes.append(input_ids.size(0))
+        outputs = self.model(input_ids, past_key_values=past, attention_mask=attention_mask, position_ids=position_ids)
+        return outputs.logits[:, -1, :], to_past(outputs.past_key_values)
+
+
+def greedy(model, input_ids, max_new_tokens, stop_ids=(), eos_ids=(), prefill_logits=True):
+    ''' Greedy decoding of one request, running the model on the whole sequence for every token. Without
+        `prefill_logits`, the last prompt token is fed again as the first input, as the engine does. '''
+    ids = list(input_ids) + ([] if prefill_logits else [input_ids[-1]])
+    generated = []
+    with torch.no_grad():
+        while len(generated) < max_new_tokens:
+            token = model(torch.tensor([ids])).logits[0, -1].argmax().item()
+            if token in eos_ids:
+                break
+            generated.append(token)
+            ids.append(token)
+            if token in stop_ids:
+                break
+    return generated
+
+
+def make_requests(model, n, prefill_logits, seed=0):
+    ''' Prompts of different lengths and budgets, some of which end at a stop or eos token they generate '''
+    rng = random.Random(seed)
+    requests = []
+    for i in range(n):
+        input_ids = [rng.randrange(VOCAB_SIZE) for _ in range(rng.randint(1, 40))]
+        max_new_tokens = rng.randint(1, 24)
+        stop_ids, eos_ids = (), ()
+        if i % 3 > 0:
+            unstopped = greedy(model, input_ids, max_new_tokens, prefill_logits=prefill_logits)
+            stop = {unstopped[len(unstopped) // 2]}
+            stop_ids, eos_ids = (stop, ()) if i % 3 == 1 else ((), stop)
+        requests.append(dict(input_ids=input_ids, max_new_tokens=max_new_tokens, stop_ids=stop_ids, eos_ids=eos_ids))
+    return requests
+
+
+def reference(model, requests, prefill_logits):
+    return [greedy(model, **request, prefill_logits=prefill_logits) for request in requests]
+
+
+@pytest.mark.parametrize('prefill_logits', [False, True])
+def test_requests_joining_and_leaving(model, prefill_logits):
+    # the first request decodes until the others are done, so they join and leave a running batch
+    requests = [dict(input_ids=[3] * 5, max_new_tokens=120, stop_ids=(), eos_ids=())]
+    requests += make_requests(model, 12, prefill_logits)
+    futures = {}
+
+    def on_step(step):
+        # a few requests join at every step, more than fit in the batch
+        for i in range(1 + 3 * step, min(4 + 3 * step, len(requests))):
+            futures[i] = engine.submit(**requests[i])
+
+    adapter = GPT2Adapter(model, prefill_logits, on_step)
+    engine = DecodeEngine(f'test-join-{prefill_logits}', adapter, torch.device('cpu'), max_batch_size=4)
+    futures[0] = engine.submit(**requests[0])
+    futures[0].result(timeout=60)
+
+    results = [futures[i].result(timeout=60) for i in range(len(requests))]
+    assert results == reference(model, requests, prefill_logits)
+    assert max(adapter.batch_sizes) == 4 and adapter.batch_sizes[-1] == 1
+    # requests left the batch while others kept decoding
+    assert any(b < a for a, b in zip(adapter.batch_sizes, adapter.batch_sizes[1:]))
+
+
+@pytest.mark.parametrize('prefill_logits', [False, True])
+def test_concurrent_requests(model, prefill_logits):
+    requests = make_requests(model, 16, prefill_logits, seed=1)
+    adapter = GPT2Adapter(model, prefill_logits)
+    engine = DecodeEngine(f'test-concurrent-{prefill_logits}', adapter, torch.device('cpu'), max_batch_size=8)
+    results = [None] * len(requests)
+
+    def generate(i):
+        time.sleep(random.Random(i).uniform(0, 0.05))
+        results[i] = engine.generate(**requests[i])
+
+    threads = [threading.Thread(target=generate, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=60)
+    assert results == reference(model, requests, prefill_logits)
+
+
+@pytest.mark.parametrize('prefill_logits', [False, True])
+def test_prefix_cache_reuse(model, prefill_logits):
+    ''' Successive prompts of a session only prefill the tokens after the prompts' common prefix '''
+    rng = random.Random(2)
+    prompt = [rng.randrange(VOCAB_SIZE) for _ in range(30)]
+    prompts = [prompt, prompt + [1, 2, 3], prompt[:20] + [4, 5], prompt[:20] + [4, 5, 6]]
+    prefilled = []
+
+    class PrefillCounter(GPT2Adapter):
+        def prefill(self, input_ids, past=None):
+            prefilled.append(input_ids.size(1))
+            return super().prefill(input_ids, past)
+
+    adapter = PrefillCounter(model, prefill_logits)
+    engine = DecodeEngine(f'test-prefix-{prefill_logits}', adapter, torch.device('cpu'))
+    # decodes alongside the session's requests, so that they join a running batch
+    other = dict(input_ids=[7] * 10, max_new_tokens=200)
+    background = engine.submit(**other)
+
+    hits = prefix_cache.hits
+    results = [engine.generate(input_ids, 12, session='session') for input_ids in prompts]
+    assert prefix_cache.hits - hits == 3
+    assert prefilled[1:] == [len(prompts[0]), 3, 2, 1]
+    assert results == [greedy(model, input_ids, 12, prefill_logits=prefill_logits) for input_ids in prompts]
+    assert background.result(timeout=60) == greedy(model, **other, prefill_logits=prefill_logits)
@@ -0,0 +1,54 @@
+import os, random, pytest
+
+pytest.importorskip('transformers')
+
+from transformers import AutoTokenizer
+from tokenization import joint_token_ids
+from bench_joint_tokenization import reference_token_ids
+
+''' Compares `joint_token_ids` to the previous joint tokenisation of the transformer filters (kept as
+    `reference_token_ids` in bench_joint_tokenization.py), on synthetic contexts: empty ones, ones without
+    newlines, and ones longer than the budget. The filters' tokenizer is loaded from the hub (or
+    FILTER_TOKENIZER), and the tests are skipped without it. '''
+
+FILTER_TOKENIZER = os.getenv('FILTER_TOKENIZER', 'huggingface/CodeBERTa-small-v1')
+
+
+@pytest.fixture(scope='module')
+def tokenizer():
+    try:
+        return AutoTokenizer.from_pretrained(FILTER_TOKENIZER)
+    except (OSError, ValueError) as e:
+        pytest.skip(f'tokenizer not available: {e}')
+
+
+def synthetic_code(rng: random.Random, n_lines: int) -> str:
+    lines = []
+    for i in range(n_lines):
+        indent = '    ' * rng.randint(0, 3)
+        lines.append(indent + rng.choice([
+            f'def function_{i}(self, x, y=None):',
+            f'return self.values[{i}] + "</s>"',
+            f'# comment {i}   ',
+            '',
+        ]))
+    return '\n'.join(lines)
+
+
+def contexts():
+    rng = random.Random(0)
+    short, long = synthetic_code(rng, 3), synthetic_code(rng, 400)
+    no_newlines = ' + '.join(f'value_{i}' for i in range(1500))
+    return [
+        ('', ''), ('', short), (short, ''), ('', long), (long, ''),
+        (short, short), (long, short), (short, long), (long, long),
+        (no_newlines, ''), ('', no_newlines), (no_newlines, no_newlines), ('x', 'y'),
+        *[(synthetic_code(rng, rng.randint(0, 80)), synthetic_code(rng, rng.randint(0, 80))) for _ in range(20)],
+    ]
+
+
+@pytest.mark.parametrize('max_length, max_suffix_tokens', [(512, 128), (64, 16), (16, 8)])
+def test_joint_token_ids(tokenizer, max_length, max_suffix_tokens):
+    for prefix, suffix in contexts():
+        expected = reference_token_ids(tokenizer, prefix, suffix, max_length, max_suffix_tokens)
+        assert joint_token_ids(tokenizer, prefix, suffix, max_length, max_suffix_tokens) == expected, (prefix, suffix)
@@ -0,0 +1,82 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+from transformers import RobertaConfig
+from modeling_jonberta import SelfAttention, ScaledCrossAttention, config_has
+
+''' Compares the single-feature fast paths of Jonberta's attention modules, which only run in eval mode, to
+    the full computation. Dropout is 0, so the full computation is forced by switching to train mode. '''
+
+BATCH_SIZE, SEQ_LEN, HIDDEN_SIZE, FEATURE_HIDDEN_SIZE = 3, 7, 32, 8
+
+
+def make_config(**kwargs):
+    config = RobertaConfig(hidden_size=HIDDEN_SIZE, num_attention_heads=4, attention_probs_dropout_prob=0.0,
+                           feature_hidden_size=FEATURE_HIDDEN_SIZE, num_telemetry_features=1,
+                           num_cross_attn_heads=1, cross_attn_dropout_probs=0.0, **kwargs)
+    config.get = lambda *args: config_has(config, args)
+    return config
+
+
+def padding_mask(generator):
+    ''' Additive attention mask, as RobertaModel passes it to the layers, with padding at the end of each row '''
+    lengths = torch.randint(1, SEQ_LEN + 1, (BATCH_SIZE,), generator=generator)
+    mask = (torch.arange(SEQ_LEN).unsqueeze(0) < lengths.unsqueeze(1)).float()
+    return ((1.0 - mask) * torch.finfo(torch.float).min)[:, None, None, :]
+
+
+def fast_and_full(module, *args, **kwargs):
+    with torch.no_grad():
+        module.eval()
+        fast = module(*args, **kwargs)
+        module.train()
+        full = module(*args, **kwargs)
+    return fast, full
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('masked', [False, True])
+def test_self_attention_single_feature_key(seed, masked):
+    generator = torch.Generator().manual_seed(seed)
+    torch.manual_seed(seed)
+    attention = SelfAttention(make_config())
+
+    hidden_states = torch.randn(BATCH_SIZE, SEQ_LEN, HIDDEN_SIZE, generator=generator)
+    features = torch.randn(BATCH_SIZE, 1, FEATURE_HIDDEN_SIZE, generator=generator)
+    attention_mask = padding_mask(generator) if masked else None
+
+    fast, full = fast_and_full(attention, hidden_states, attention_mask=attention_mask, encoder_hidden_states=features)
+    torch.testing.assert_close(fast[0], full[0])
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('share_values', [False, True])
+@pytest.mark.parametrize('masked', [False, True])
+def test_scaled_cross_attention_single_feature(seed, share_values, masked):
+    generator = torch.Generator().manual_seed(seed)
+    torch.manual_seed(seed)
+    attention = ScaledCrossAttention(make_config(share_values=share_values))
+
+    hidden_states = torch.randn(BATCH_SIZE, SEQ_LEN, HIDDEN_SIZE, generator=generator)
+    features = torch.randn(BATCH_SIZE, 1, generator=generator)
+    if share_values:
+        # what JonbertaEncoder.prepare_features passes on with shared values
+        features = (features.unsqueeze(-1) * torch.randn(1, HIDDEN_SIZE, generator=generator)).unsqueeze(1)
+    attention_mask = padding_mask(generator) if masked else None
+
+    fast, full = fast_and_full(attention, hidden_states, attention_mask=attention_mask, encoder_hidden_states=features)
+    torch.testing.assert_close(fast[0], full[0])
+    if not share_values:
+        torch.testing.assert_close(fast[-1][1], full[-1][1])
+
+
+def test_self_attention_multiple_feature_keys_use_the_full_computation():
+    generator = torch.Generator().manual_seed(0)
+    attention = SelfAttention(make_config())
+    hidden_states = torch.randn(BATCH_SIZE, SEQ_LEN, HIDDEN_SIZE, generator=generator)
+    features = torch.randn(BATCH_SIZE, 26, FEATURE_HIDDEN_SIZE, generator=generator)
+
+    fast, full = fast_and_full(attention, hidden_states, encoder_hidden_states=features)
+    torch.testing.assert_close(fast[0], full[0])
@@ -0,0 +1,74 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+import modeling_jonberta
+from transformers import RobertaConfig
+from modeling_jonberta import SelfAttention, config_has
+
+''' Compares SelfAttention's fused attention kernel to the manual matmul/softmax computation it falls back to,
+    by turning `FUSED_ATTENTION` off. The pinned torch 1.13 has the kernel as `_scaled_dot_product_attention`. '''
+
+BATCH_SIZE, SEQ_LEN, HIDDEN_SIZE, FEATURE_HIDDEN_SIZE = 3, 7, 32, 8
+
+pytestmark = pytest.mark.skipif(not modeling_jonberta.FUSED_ATTENTION, reason='no fused attention kernel')
+
+
+def make_config(**kwargs):
+    config = RobertaConfig(hidden_size=HIDDEN_SIZE, num_attention_heads=4, attention_probs_dropout_prob=0.0,
+                           feature_hidden_size=FEATURE_HIDDEN_SIZE, num_telemetry_features=2, **kwargs)
+    config.get = lambda *args: config_has(config, args)
+    return config
+
+
+def padding_mask(generator):
+    ''' Additive attention mask, as RobertaModel passes it to the layers, with padding at the end of each row '''
+    lengths = torch.randint(1, SEQ_LEN + 1, (BATCH_SIZE,), generator=generator)
+    mask = (torch.arange(SEQ_LEN).unsqueeze(0) < lengths.unsqueeze(1)).float()
+    return ((1.0 - mask) * torch.finfo(torch.float).min)[:, None, None, :]
+
+
+def fused_and_manual(monkeypatch, module, *args, **kwargs):
+    module.eval()
+    with torch.no_grad():
+        fused = module(*args, **kwargs)
+        monkeypatch.setattr(modeling_jonberta, 'FUSED_ATTENTION', False)
+        manual = module(*args, **kwargs)
+    return fused, manual
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('masked', [False, True])
+@pytest.mark.parametrize('n_features', [1, 2])
+def test_fused_attention(monkeypatch, seed, masked, n_features):
+    generator = torch.Generator().manual_seed(seed)
+    torch.manual_seed(seed)
+    attention = SelfAttention(make_config())
+
+    hidden_states = torch.randn(BATCH_SIZE, SEQ_LEN, HIDDEN_SIZE, generator=generator)
+    features = torch.randn(BATCH_SIZE, n_features, FEATURE_HIDDEN_SIZE, generator=generator)
+    attention_mask = padding_mask(generator) if masked else None
+
+    fused, manual = fused_and_manual(monkeypatch, attention, hidden_states, attention_mask=attention_mask,
+                                     encoder_hidden_states=features)
+    torch.testing.assert_close(fused[0], manual[0])
+
+
+@pytest.mark.parametrize('config, head_mask', [
+    ({'position_embedding_type': 'relative_key'}, False),
+    ({'position_embedding_type': 'relative_key_query'}, False),
+    ({}, True),
+])
+def test_manual_attention_fallback(monkeypatch, config, head_mask):
+    ''' Relative position scores and head masks are only supported by the manual computation '''
+    monkeypatch.setattr(modeling_jonberta, 'fused_attention', None)  # fails if it is called
+    generator = torch.Generator().manual_seed(0)
+    attention = SelfAttention(make_config(**config)).eval()
+
+    hidden_states = torch.randn(BATCH_SIZE, SEQ_LEN, HIDDEN_SIZE, generator=generator)
+    features = torch.randn(BATCH_SIZE, 2, FEATURE_HIDDEN_SIZE, generator=generator)
+    with torch.no_grad():
+        output = attention(hidden_states, head_mask=torch.ones(1, 4, 1, 1) if head_mask else None,
+                           encoder_hidden_states=features)
+    assert output[0].shape == (BATCH_SIZE, SEQ_LEN, HIDDEN_SIZE)
@@ -0,0 +1,76 @@
+import math, random, pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+try:
+    from query_filter import Logres, logres
+except OSError as e:  # the filters' tokenizer is loaded when importing
+    pytest.skip(f'tokenizer not available: {e}', allow_module_level=True)
+
+''' Compares `Logres.predict_batch`, which builds the features of all requests at once and looks up the weights of
+    the one-hot features, to the per-request computation it replaced (kept below as `reference_predict`). '''
+
+
+def reference_features(X: dict) -> np.ndarray:
+    ''' The previous `Logres._preprocess` '''
+
+    document_length = len(X['prefix']) + len(X['suffix'])
+    offset = len(X['prefix'])
+    offset_percentage = offset / document_length
+    whitespace_after_cursor = 1 if (len(X['suffix']) >= 1 and X['suffix'][0] == ' ') else 0
+    last_prefix_line = X['prefix'].split('\n')[-1]
+    last_prefix_line_stripped = last_prefix_line.rstrip()
+
+    return np.array([
+        math.log(1 + X['time_since_last_completion']),
+        math.log(1 + document_length),
+        math.log(1 + offset),
+        offset_percentage,
+        *Logres.lang_map(X['language']),
+        whitespace_after_cursor,
+        math.log(1 + len(last_prefix_line)),
+        math.log(1 + len(last_prefix_line_stripped)),
+        *Logres.character_map(last_prefix_line[-1] if len(last_prefix_line) > 0 else chr(0)),
+        *Logres.character_map(last_prefix_line_stripped[-1] if len(last_prefix_line_stripped) > 0 else chr(0)),
+    ])
+
+
+def reference_predict(model: Logres, X: dict) -> bool:
+    ''' The previous `Logres.predict` '''
+    return not bool(reference_features(X) @ model.weights + model.intercept > 0)
+
+
+def requests(n: int = 200):
+    rng = random.Random(0)
+    languages = Logres.SUPPORTED_LANGS + ['plaintext', 'kotlin']
+    last_chars = ['', ' ', '\t', '(', '.', '=', 'a', 'Z', '9', '}', 'é', ' ', '😀']
+    for _ in range(n):
+        prefix = '\n'.join('    ' * rng.randint(0, 2) + rng.choice(['x = f(y)', 'def g():', ''])
+                           for _ in range(rng.randint(0, 5)))
+        prefix += rng.choice(['', '\n', '    ']) + rng.choice(last_chars) + rng.choice(['', '  ', '\t '])
+        suffix = rng.choice(['', ' ', ' x)', '\n    return', ')\n'])
+        if len(prefix) + len(suffix) == 0:
+            suffix = ' '
+        yield {
+            'prefix': prefix,
+            'suffix': suffix,
+            'language': rng.choice(languages),
+            'time_since_last_completion': rng.choice([0.0, rng.uniform(0, 10), rng.uniform(0, 1800)]),
+        }
+
+
+def test_predict_batch_matches_reference():
+    Xs = list(requests())
+    assert logres.predict_batch(Xs) == [reference_predict(logres, X) for X in Xs]
+    assert [logres.predict(X) for X in Xs] == [reference_predict(logres, X) for X in Xs]
+
+
+def test_predict_batch_scores():
+    ''' Random weights, so that every feature counts, instead of only those the trained model uses '''
+    rng = np.random.default_rng(0)
+    Xs = list(requests())
+    for _ in range(5):
+        model = Logres(rng.normal(size=logres.weights.shape), rng.normal())
+        assert model.predict_batch(Xs) == [reference_predict(model, X) for X in Xs]
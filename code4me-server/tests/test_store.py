@@ -0,0 +1,250 @@
+import os
+import time
+import threading
+import pytest
+
+import store
+from store import LogStore, InvalidToken, AlreadyVerified
+
+''' The log store's recovery, counts, verify and reassembly of chunked contexts, and its failed writes: a partially
+    written batch must be truncated away, so that the index entries of later records point at the right bytes, and
+    a batch that keeps failing must not stay queued. '''
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    monkeypatch.setattr(store, 'WRITE_RETRY_SECONDS', 0.0)
+
+
+def failing_writes(store_, failures, skip=0):
+    ''' Make `failures` writes of `store_`, after the next `skip`, write half of their lines and then fail '''
+    write_lines, skipped, remaining = store_._write_lines, [0], [failures]
+
+    def _write_lines(lines):
+        if len(lines) > 0 and skipped[0] < skip:
+            skipped[0] += 1
+        elif remaining[0] > 0 and len(lines) > 0:
+            remaining[0] -= 1
+            data = b''.join(lines)
+            store_.segment_file.write(data[:len(data) // 2])
+            store_.segment_file.flush()
+            raise OSError(28, 'No space left on device')
+        write_lines(lines)
+
+    store_._write_lines = _write_lines
+    return remaining
+
+
+def wait_until_taken(store_):
+    ''' Wait until the writer took the queued records, so the records queued next are written as one batch '''
+    while not store_.queue.empty():
+        time.sleep(0.001)
+
+
+def test_partial_write_is_retried(tmp_path):
+    s = LogStore(str(tmp_path), chunked_fields=('prefix',))
+    s.append('user', 'token-0', {'prefix': 'a\n' * 10})
+    failing_writes(s, 1)
+    s.append('user', 'token-1', {'prefix': 'b\n' * 10, 'n': 1})
+    s.close()
+    assert s.stats()['failed_writes'] == 1 and s.stats()['failed_records'] == 0
+
+    reopened = LogStore(str(tmp_path), chunked_fields=('prefix',), read_only=True)
+    assert reopened.get('token-0')['data'] == {'prefix': 'a\n' * 10}
+    assert reopened.get('token-1')['data'] == {'prefix': 'b\n' * 10, 'n': 1}
+    assert reopened.count('user') == 2
+
+
+def test_failed_batch_is_dropped(tmp_path):
+    s = LogStore(str(tmp_path), chunked_fields=('prefix',))
+    s.append('user', 'token-0', {'prefix': 'a\n'})
+    s.close()
+
+    s = LogStore(str(tmp_path), chunked_fields=('prefix',))
+    with s.write_lock:
+        s.verify('user', 'token-0', {'verified': 1})
+        wait_until_taken(s)
+        s.append('user', 'token-1', {'prefix': 'b\n'})
+        remaining = failing_writes(s, 2 * store.WRITE_ATTEMPTS)
+    s.close()
+    assert remaining[0] == 0
+    assert s.stats()['pending'] == 0 and s.stats()['failed_records'] > 0
+    assert 'token-1' not in s and s.count('user') == 1
+
+    # the lost verify record does not block verifying the token again
+    s = LogStore(str(tmp_path), chunked_fields=('prefix',))
+    s.verify('user', 'token-0', {'verified': 2})
+    s.append('user', 'token-2', {'prefix': 'b\n'})
+    s.close()
+    reopened = LogStore(str(tmp_path), chunked_fields=('prefix',), read_only=True)
+    assert reopened.get('token-0')['data'] == {'prefix': 'a\n', 'verified': 2}
+    assert reopened.get('token-2')['data'] == {'prefix': 'b\n'}
+    assert os.path.getsize(tmp_path / store.INDEX_FILE) % store.INDEX_ENTRY.size == 0
+
+
+def test_failed_write_after_rotation(tmp_path):
+    s = LogStore(str(tmp_path), segment_max_bytes=200)
+    s.append('user', 'token-0', {'prefix': 'a' * 100})
+    s.close()
+
+    s = LogStore(str(tmp_path), segment_max_bytes=200)
+    with s.write_lock:
+        s.append('user', 'token-1', {'prefix': 'b' * 100})
+        wait_until_taken(s)
+        # one batch, which is split over two new segments, and fails writing the second
+        s.append('user', 'token-2', {'prefix': 'c' * 100})
+        s.append('user', 'token-3', {'prefix': 'd' * 100})
+        failing_writes(s, 1, skip=2)
+    s.close()
+    assert s.stats()['failed_writes'] == 1 and s.segment == 3
+
+    reopened = LogStore(str(tmp_path), read_only=True)
+    assert [reopened.get(f'token-{i}')['data']['prefix'] for i in range(4)] == [c * 100 for c in 'abcd']
+
+
+def test_chunks_of_dropped_record(tmp_path):
+    s = LogStore(str(tmp_path), chunked_fields=('prefix',))
+    context = 'def f():\n' + ''.join(f'    x = {i}\n' for i in range(200))
+    with s.write_lock:
+        s.append('user', 'token-0', {'prefix': context})
+        wait_until_taken(s)
+        failing_writes(s, store.WRITE_ATTEMPTS)
+        # refers to the queued chunks of token-0, in the next batch
+        s.append('user', 'token-1', {'prefix': context + 'y\n'})
+    s.close()
+    assert s.stats()['failed_records'] == 1 and s.stats()['pending'] == 0
+
+    reopened = LogStore(str(tmp_path), chunked_fields=('prefix',), read_only=True)
+    assert 'token-0' not in reopened
+    assert reopened.get('token-1')['data'] == {'prefix': context + 'y\n'}
+
+
+def context(n_lines, start=0):
+    return 'def f():\n' + ''.join(f'    x = {i}\n' for i in range(start, start + n_lines))
+
+
+def test_recovery_of_partial_record(tmp_path):
+    s = LogStore(str(tmp_path), chunked_fields=('prefix',))
+    for i in range(3):
+        s.append('user', f'token-{i}', {'prefix': context(100, i), 'n': i})
+    s.close()
+
+    # a crash while writing the last record, and the index entries of the records before it
+    segment_path = s.segment_path(s.segment)
+    segment_size = os.path.getsize(segment_path)
+    with open(segment_path, 'ab') as f:
+        f.write(b'{"user": "user", "token": "token-3", "da')
+    index_path = tmp_path / store.INDEX_FILE
+    os.truncate(index_path, os.path.getsize(index_path) - store.INDEX_ENTRY.size - 3)
+
+    s = LogStore(str(tmp_path), chunked_fields=('prefix',))
+    assert os.path.getsize(segment_path) == segment_size
+    assert [s.get(f'token-{i}')['data'] for i in range(3)] == [{'prefix': context(100, i), 'n': i} for i in range(3)]
+    assert 'token-3' not in s and s.count('user') == 3
+
+    # the index is complete again, and later records are appended after the truncated one
+    s.append('user', 'token-3', {'prefix': context(100, 3), 'n': 3})
+    s.close()
+    reopened = LogStore(str(tmp_path), chunked_fields=('prefix',), read_only=True)
+    assert os.path.getsize(index_path) % store.INDEX_ENTRY.size == 0
+    assert [reopened.get(f'token-{i}')['data']['n'] for i in range(4)] == [0, 1, 2, 3]
+    assert len(reopened.index) == 4 and reopened.count('user') == 4
+
+
+def test_recovery_of_lost_records(tmp_path):
+    s = LogStore(str(tmp_path))
+    for i in range(3):
+        s.append('user', f'token-{i}', {'n': i})
+    s.close()
+
+    # the index was written, but the end of the segment was not
+    segment_path = s.segment_path(s.segment)
+    os.truncate(segment_path, os.path.getsize(segment_path) - 5)
+
+    s = LogStore(str(tmp_path))
+    assert [s.get(f'token-{i}')['data']['n'] for i in range(2)] == [0, 1]
+    assert 'token-2' not in s and s.count('user') == 2
+    assert os.path.getsize(tmp_path / store.INDEX_FILE) == 2 * store.INDEX_ENTRY.size
+    s.close()
+
+
+def test_count(tmp_path):
+    s = LogStore(str(tmp_path))
+    for i in range(3):
+        s.append('user-a', f'token-a{i}', {'n': i})
+    s.append('user-a', 'token-a0', {'n': 3})  # replaces the first record
+    s.append('user-a', '', {'filtered': True})  # not indexed
+    s.append('user-b', 'token-b0', {'n': 0})
+    assert (s.count('user-a'), s.count('user-b'), s.count('user-c')) == (3, 1, 0)
+    s.verify('user-a', 'token-a1', {'verified': True})
+    s.close()
+
+    reopened = LogStore(str(tmp_path), read_only=True)
+    assert (reopened.count('user-a'), reopened.count('user-b'), reopened.count('user-c')) == (3, 1, 0)
+    assert reopened.get('token-a0')['data'] == {'n': 3}
+
+
+@pytest.mark.parametrize('flushed', [False, True])
+def test_concurrent_verify(tmp_path, flushed):
+    s = LogStore(str(tmp_path))
+    s.append('user', 'token', {'n': 0})
+    if flushed:
+        s.close()
+        s = LogStore(str(tmp_path))
+
+    n_threads = 16
+    barrier, results = threading.Barrier(n_threads), []
+
+    def verify(i):
+        barrier.wait()
+        try:
+            s.verify('user', 'token', {'verified': i})
+            results.append(i)
+        except AlreadyVerified:
+            results.append(None)
+
+    threads = [threading.Thread(target=verify, args=(i,)) for i in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    succeeded = [i for i in results if i is not None]
+    assert len(results) == n_threads and len(succeeded) == 1
+
+    with pytest.raises(InvalidToken):
+        s.verify('other-user', 'token', {'verified': -1})
+    with pytest.raises(InvalidToken):
+        s.verify('user', 'unknown-token', {'verified': -1})
+    assert s.get('token')['data'] == {'n': 0, 'verified': succeeded[0]}
+    s.close()
+
+    s = LogStore(str(tmp_path))
+    with pytest.raises(AlreadyVerified):
+        s.verify('user', 'token', {'verified': -1})
+    assert s.get('token')['data'] == {'n': 0, 'verified': succeeded[0]}
+    s.close()
+
+
+@pytest.mark.parametrize('compress', [False, pytest.param(True, marks=pytest.mark.skipif(
+    store.zstandard is None, reason='zstandard is not installed'))])
+def test_get_reassembles_chunks(tmp_path, compress):
+    s = LogStore(str(tmp_path), chunked_fields=('prefix', 'suffix'), compress=compress)
+    prefixes = [context(300), context(300) + '    y = 1\n', context(300, 7)]
+    data = [{'prefix': prefix, 'suffix': context(50, 1000), 'n': i} for i, prefix in enumerate(prefixes)]
+
+    # queued, and read from the queued chunk lines
+    with s.write_lock:
+        for i, d in enumerate(data):
+            s.append('user', f'token-{i}', d)
+        assert s.stats()['pending'] > 0
+        assert [s.get(f'token-{i}')['data'] for i in range(3)] == data
+    s.close()
+    # the suffix, and most of the prefix, of the later records are the first one's chunks
+    n_chunks = sum(len(store.split_chunks(d['prefix'])) + len(store.split_chunks(d['suffix'])) for d in data)
+    assert s.stats()['new_chunks'] + s.stats()['reused_chunks'] == n_chunks
+    assert s.stats()['reused_chunks'] > s.stats()['new_chunks'] == s.stats()['chunks']
+
+    assert [s.get(f'token-{i}')['data'] for i in range(3)] == data
+    reopened = LogStore(str(tmp_path), chunked_fields=('prefix', 'suffix'), read_only=True)
+    assert [reopened.get(f'token-{i}')['data'] for i in range(3)] == data
+    assert [record['data'] for record in reopened.records()] == data
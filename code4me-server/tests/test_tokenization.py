@@ -0,0 +1,105 @@
+import os, random, pytest
+
+pytest.importorskip('transformers')
+
+from transformers import AutoTokenizer, RobertaTokenizer, RobertaTokenizerFast
+from tokenization import codegpt_tokenizer, tail_token_ids, head_token_ids
+
+''' Compares the bounded `tail_token_ids`/`head_token_ids` of each model's tokenizer to the ids the models were
+    prompted with before, i.e. the slow tokenizers on the whole context, on synthetic indented contexts. The
+    tokenizers are loaded from the hub (or CODEGPT_CHECKPOINT_PATH), and the tests are skipped without them. '''
+
+CODEGPT_CHECKPOINT = os.getenv('CODEGPT_CHECKPOINT_PATH', 'microsoft/CodeGPT-small-py')
+BUDGETS = [1, 16, 64, 959]
+
+
+def load(from_pretrained, *args):
+    try:
+        return from_pretrained(*args)
+    except (OSError, ValueError) as e:
+        pytest.skip(f'tokenizer not available: {e}')
+
+
+def synthetic_file(rng: random.Random) -> str:
+    ''' Python-like code with nested indentation, tabs, blank and whitespace-only lines, trailing whitespace,
+        CRLF line ends and special-token-like text '''
+
+    lines, depth = [], 0
+    for i in range(rng.randint(20, 200)):
+        indent = rng.choice(['    ', '\t', '  ']) * depth
+        line = rng.choice([
+            f'def function_{i}(self, x, y=None):',
+            f'if x_{i} is not None and x_{i} > {rng.randint(0, 100)}:',
+            f'return self.values[{i}] + "<s> </s>"',
+            f'# comment with trailing whitespace {i}   ',
+            f'value = {{"key": [1, 2, 3], "other": \'ünïcödé\'}}',
+            '',
+            '   ',
+        ])
+        lines.append(indent + line if line.strip() else line)
+        depth = max(0, min(4, depth + rng.choice([-1, 0, 0, 1]) + (line.endswith(':'))))
+    return rng.choice(['\n', '\n', '\r\n']).join(lines)
+
+
+def contexts(n: int = 40):
+    ''' (prefix, suffix) pairs, split at a random cursor position, often in the middle of a line '''
+    rng = random.Random(0)
+    for _ in range(n):
+        text = synthetic_file(rng)
+        cursor = rng.randint(0, len(text))
+        yield text[:cursor], text[cursor:]
+
+
+@pytest.fixture(scope='module')
+def codegpt_tokenizers():
+    return load(codegpt_tokenizer, CODEGPT_CHECKPOINT, False), load(codegpt_tokenizer, CODEGPT_CHECKPOINT)
+
+
+def test_codegpt_matches_slow_tokenizer(codegpt_tokenizers):
+    ''' codegpt.py used to run the slow GPT2Tokenizer over the whole left context, which strips the
+        whitespace around `<EOL>`, and keep the last tokens '''
+
+    slow, fast = codegpt_tokenizers
+    for prefix, _ in contexts():
+        left_context = prefix.replace('\n', '<EOL>')
+        expected = slow.encode(left_context)
+        for budget in BUDGETS:
+            assert tail_token_ids(fast, left_context, budget, boundary='<EOL>') == expected[-budget:]
+
+
+def test_codegpt_strips_indentation_after_eol(codegpt_tokenizers):
+    slow, fast = codegpt_tokenizers
+    left_context = 'def f(x):<EOL>    return x<EOL>\t\tpass'
+    assert fast.encode(left_context) == slow.encode(left_context)
+    assert fast.encode(left_context) == fast.encode('def f(x):<EOL>return x<EOL>pass')
+
+
+def test_unixcoder_matches_slow_tokenizer():
+    ''' unixcoder.py used to tokenize the whole left context with the slow RobertaTokenizer '''
+
+    slow = load(RobertaTokenizer.from_pretrained, 'microsoft/unixcoder-base')
+    fast = load(RobertaTokenizerFast.from_pretrained, 'microsoft/unixcoder-base')
+    for prefix, _ in contexts():
+        expected = slow.convert_tokens_to_ids(slow.tokenize(prefix))
+        for budget in BUDGETS:
+            assert tail_token_ids(fast, prefix, budget) == expected[-budget:]
+
+
+def test_incoder_matches_whole_context():
+    ''' incoder.py used to tokenize both contexts as a whole (after its `<s>`), and truncate them '''
+
+    tokenizer = load(AutoTokenizer.from_pretrained, 'facebook/incoder-1B')
+    for prefix, suffix in contexts():
+        left_expected = tokenizer(prefix).input_ids[1:]
+        right_expected = tokenizer(suffix).input_ids[1:]
+        for budget in BUDGETS + [2000]:
+            assert tail_token_ids(tokenizer, prefix, budget) == left_expected[-budget:]
+            assert head_token_ids(tokenizer, suffix, budget) == right_expected[:budget]
+
+
+@pytest.mark.parametrize('budget', [0, -1])
+def test_empty_budget(budget):
+    ''' No tokens, without tokenising (the window would never grow from 0 characters) '''
+    text = 'def f(x):\n    return x\n' * 100
+    assert tail_token_ids(None, text, budget) == []
+    assert head_token_ids(None, text, budget) == []